@@ -0,0 +1,73 @@
+"""Serial vs. concurrent resolution of one report's queries.
+
+    python bench/bench_fanout.py --delay 0.05
+
+Runs against bench/stub_dns.py, so every lookup costs --delay seconds.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dns.resolver
+
+from bench.stub_dns import StubServer
+from query.resolve import QueryPlan, query_key
+
+DOMAIN = "example.com"
+
+
+def serial(resolver, queries, ns_hosts):
+    for name, rdtype in queries + [(ns, "A") for ns in ns_hosts]:
+        try:
+            resolver.resolve(name, rdtype)
+        except Exception:
+            pass
+
+
+def concurrent(resolver, queries, ns_hosts):
+    plan = QueryPlan(resolver=resolver, max_workers=16, use_cache=False)
+    for name, rdtype in queries:
+        plan.add(name, rdtype)
+    plan.resolve()
+    for data in plan.get(DOMAIN, "NS"):
+        plan.add(str(data), "A")
+    plan.resolve()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--delay", type=float, default=0.05)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    import django
+    from django.conf import settings
+    settings.configure()
+    django.setup()
+
+    server = StubServer(delay=args.delay).start()
+    resolver = dns.resolver.Resolver(configure=False)
+    resolver.nameservers = ["127.0.0.1"]
+    resolver.port = server.port
+    from query.checks import report_queries
+    queries = report_queries(DOMAIN)
+    ns_hosts = [str(ns) for ns in resolver.resolve(DOMAIN, "NS")]
+    unique = len(set(query_key(*q) for q in queries)) + len(ns_hosts)
+    print("%d lookups per report, %.0f ms stub latency" % (unique, args.delay * 1000))
+
+    for label, func in (("serial", serial), ("concurrent", concurrent)):
+        timings = []
+        for _ in range(args.rounds):
+            start = time.perf_counter()
+            func(resolver, queries, ns_hosts)
+            timings.append(time.perf_counter() - start)
+        print("%-10s best %7.1f ms  mean %7.1f ms" % (
+            label, min(timings) * 1000, sum(timings) / len(timings) * 1000))
+    server.stop()
+
+
+if __name__ == "__main__":
+    main()
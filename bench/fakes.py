@@ -0,0 +1,73 @@
+"""Stand-ins for the WHOIS and IPASN (RDAP) backends of the benchmarks.
+
+Each one sleeps --delay seconds per call, fails a --fail share of the
+calls and counts them, so a run can report upstream calls per report.
+"""
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+from ipwhois.exceptions import ASNRegistryError
+
+
+class FakeWhois(dict):
+    def __getattr__(self, name):
+        return self.get(name)
+
+    def __str__(self):
+        return "{\n" + ",\n".join('  "%s": "%s"' % item for item in self.items()) + "\n}"
+
+
+class Upstream:
+    error = RuntimeError
+
+    def __init__(self, delay=0.0, fail=0.0):
+        self.delay = delay
+        self.fail = fail
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def call(self, what):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.delay)
+        if self.fail and random.random() < self.fail:
+            raise self.error("injected failure for %s" % what)
+
+
+class WhoisBackend(Upstream):
+    # replaces whois.whois
+    def __call__(self, domain):
+        self.call(domain)
+        return FakeWhois(domain_name=domain, registrar="Example Registrar",
+                         name_servers=["ns1.%s" % domain, "ns2.%s" % domain],
+                         expiration_date="2030-01-01 00:00:00")
+
+
+class ASNBackend(Upstream):
+    # replaces ipwhois.asn.IPASN; every /24 is its own announced prefix
+    error = ASNRegistryError
+
+    def __call__(self, net):
+        return SimpleNamespace(lookup=lambda: self.lookup(net.address_str))
+
+    def lookup(self, ip):
+        self.call(ip)
+        prefix = ip.rsplit(".", 1)[0] + ".0/24"
+        return {"asn": "645%02d" % (int(ip.split(".")[1]) % 100), "asn_cidr": prefix,
+                "asn_country_code": "TW", "asn_registry": "apnic",
+                "asn_description": "BENCH-NET %s" % prefix}
+
+
+def install(whois_backend=None, asn_backend=None):
+    if whois_backend is not None:
+        import whois
+        whois.whois = whois_backend
+    if asn_backend is not None:
+        # query.asncache imports IPASN and Net from here on its first
+        # lookup; Net would turn down the stub's loopback nameservers
+        import ipwhois.asn
+        import ipwhois.net
+        ipwhois.asn.IPASN = asn_backend
+        ipwhois.net.Net = lambda ip: SimpleNamespace(address_str=ip)
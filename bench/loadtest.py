@@ -0,0 +1,177 @@
+"""Load test of the sync views under WSGI against the async views under ASGI.
+
+    python bench/loadtest.py --concurrency 100 --requests 500 --threads 4
+
+"before" calls the WSGI application from --threads threads, like one
+threaded gunicorn worker.  "after" sends the same requests to the async
+views through the ASGI application on a single event loop.  Requests go
+straight into the applications (no HTTP server).  DNS goes to
+bench/stub_dns.py with --delay seconds per query, and WHOIS is replaced
+by a stand-in that sleeps --whois-delay seconds.  The DNS answer cache
+is disabled so every report pays for its lookups.
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+DOMAIN = "example.com"
+
+
+async def asgi_request(app, method, path, body=b""):
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+        "method": method, "scheme": "http", "path": path, "raw_path": path.encode(),
+        "query_string": b"", "root_path": "", "client": ("127.0.0.1", 50000),
+        "server": ("127.0.0.1", 80),
+        "headers": [(b"host", b"127.0.0.1"),
+                    (b"content-type", b"application/x-www-form-urlencoded"),
+                    (b"content-length", str(len(body)).encode())],
+    }
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    status = []
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await asyncio.Future()
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            status.append(message["status"])
+
+    await app(scope, receive, send)
+    return status[0]
+
+
+def wsgi_request(app, method, path, body=b""):
+    path, _, query = path.partition("?")
+    environ = {
+        "REQUEST_METHOD": method, "PATH_INFO": path, "SCRIPT_NAME": "",
+        "QUERY_STRING": query, "SERVER_NAME": "127.0.0.1", "SERVER_PORT": "80",
+        "HTTP_HOST": "127.0.0.1", "REMOTE_ADDR": "127.0.0.1",
+        "SERVER_PROTOCOL": "HTTP/1.1", "CONTENT_TYPE": "application/x-www-form-urlencoded",
+        "CONTENT_LENGTH": str(len(body)), "wsgi.input": BytesIO(body),
+        "wsgi.url_scheme": "http", "wsgi.errors": sys.stderr, "wsgi.version": (1, 0),
+        "wsgi.multithread": True, "wsgi.multiprocess": False, "wsgi.run_once": False,
+    }
+    status = []
+    for _ in app(environ, lambda s, headers, exc_info=None: status.append(int(s[:3]))):
+        pass
+    return status[0]
+
+
+def summary(latencies, elapsed, errors):
+    latencies.sort()
+    return {
+        "req/s": len(latencies) / elapsed,
+        "p50": latencies[len(latencies) // 2] * 1000,
+        "p99": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+        "errors": errors,
+    }
+
+
+async def run_asgi(app, path, concurrency, total):
+    body = ("domain=%s" % DOMAIN).encode()
+    latencies = []
+    errors = 0
+    remaining = iter(range(total))
+
+    async def client():
+        nonlocal errors
+        for _ in remaining:
+            start = time.perf_counter()
+            status = await asgi_request(app, "POST", path, body)
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return summary(latencies, time.perf_counter() - start, errors)
+
+
+def run_wsgi(app, path, concurrency, total, threads):
+    # --concurrency clients queue on a server with --threads threads;
+    # latency includes the time a request waits for a free thread
+    body = ("domain=%s" % DOMAIN).encode()
+    server = ThreadPoolExecutor(max_workers=threads)
+
+    def one(submitted):
+        status = wsgi_request(app, "POST", path, body)
+        return time.perf_counter() - submitted, status
+
+    def client(count):
+        results = []
+        for _ in range(count):
+            results.append(server.submit(one, time.perf_counter()).result())
+        return results
+
+    start = time.perf_counter()
+    per_client = [total // concurrency + (i < total % concurrency) for i in range(concurrency)]
+    with ThreadPoolExecutor(max_workers=concurrency) as clients:
+        results = [r for rs in clients.map(client, per_client) for r in rs]
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+    return summary([r[0] for r in results], elapsed, sum(1 for r in results if r[1] != 200))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--threads", type=int, default=4,
+                        help="threads of the WSGI worker in the sync run")
+    parser.add_argument("--delay", type=float, default=0.02)
+    parser.add_argument("--whois-delay", type=float, default=0.1)
+    args = parser.parse_args()
+
+    # imported here so bench/startup.py can use wsgi_request without them
+    from bench.fakes import WhoisBackend, install
+    from bench.stub_dns import StubServer
+
+    server = StubServer(delay=args.delay).start()
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "dnsquery.settings")
+    from django.conf import settings
+    settings.DNSQUERY_NAMESERVERS = ["127.0.0.1"]
+    settings.DNSQUERY_NAMESERVER_PORT = server.port
+    settings.DNSQUERY_NS_PROBE_PORT = server.port
+    settings.DNSQUERY_CACHE_MAX_ENTRIES = 0
+    settings.ALLOWED_HOSTS = ["127.0.0.1"]
+    settings.MIDDLEWARE = [m for m in settings.MIDDLEWARE if "Csrf" not in m]
+    # the views read mail_list.txt and query.db from the working directory
+    workdir = tempfile.mkdtemp()
+    shutil.copy(os.path.join(ROOT, "mail_list.txt"), workdir)
+    os.chdir(workdir)
+
+    install(WhoisBackend(args.whois_delay))
+    from django.core.asgi import get_asgi_application
+    from django.core.wsgi import get_wsgi_application
+
+    print("%d requests, %d in flight, %.0f ms per DNS query, %.0f ms per WHOIS" % (
+        args.requests, args.concurrency, args.delay * 1000, args.whois_delay * 1000))
+    results = [
+        ("sync/wsgi x%d" % args.threads,
+         run_wsgi(get_wsgi_application(), "/query/search/", args.concurrency,
+                  args.requests, args.threads)),
+        ("async/asgi",
+         asyncio.run(run_asgi(get_asgi_application(), "/query/async/search/",
+                              args.concurrency, args.requests))),
+    ]
+    for label, result in results:
+        print("%-14s %7.1f req/s  p50 %7.1f ms  p99 %7.1f ms  errors %d" % (
+            label, result["req/s"], result["p50"], result["p99"], result["errors"]))
+    server.stop()
+
+
+if __name__ == "__main__":
+    main()
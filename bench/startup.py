@@ -0,0 +1,143 @@
+"""Cold-start benchmark: how soon a new worker answers its first requests.
+
+    python bench/startup.py --runs 10
+
+Every run starts a fresh interpreter under ``python -X importtime`` that
+loads the WSGI application, serves the home page, then the report API
+of a domain on bench/stub_dns.py (WHOIS and IPASN from bench/fakes.py).
+Three kinds of worker are compared:
+
+eager   imports whois, ipwhois, pytz, dns.zone and dns.reversename
+        before Django, as query.views used to
+lazy    the current views, which load them when a check first needs them
+warmup  lazy, with DNSQUERY_WARMUP and --idle seconds between boot and
+        the first report, as when the warm-up runs ahead of traffic
+
+For each kind the median over --runs is printed: the time from process
+start to the first response, the duration of the first report request,
+and the module import time (from -X importtime) spent before the first
+response and after it, up to the end of the first report.  The
+imports of the warm-up thread count where they happen, mostly in its
+idle time.  On a single CPU the warm-up competes with the first
+response, so it pays off once workers are started ahead of traffic.
+"""
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+KINDS = ["eager", "lazy", "warmup"]
+PHASES = ["first_response", "first_report"]
+# a top-level import, with its cumulative time in microseconds
+IMPORT_LINE = re.compile(r"import time:\s+\d+ \|\s+(\d+) \| \S")
+
+
+def milestone(name, value=""):
+    # stdout for the parent's clock, stderr to split the import log
+    print(("%s %s" % (name, value)).strip(), flush=True)
+    print("milestone %s" % name, file=sys.stderr, flush=True)
+
+
+def child(kind, idle):
+    # runs in the measured interpreter; prints one line per milestone
+    if kind == "eager":
+        import dns.reversename  # noqa: F401
+        import dns.zone  # noqa: F401
+        import ipwhois  # noqa: F401
+        import pytz  # noqa: F401
+        import whois  # noqa: F401
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "dnsquery.settings")
+    from django.conf import settings
+    settings.ALLOWED_HOSTS = ["127.0.0.1"]
+    settings.DNSQUERY_WARMUP = kind == "warmup"
+    os.chdir(tempfile.mkdtemp())
+    os.symlink(os.path.join(ROOT, "mail_list.txt"), "mail_list.txt")
+
+    from django.core.wsgi import get_wsgi_application
+    from bench.loadtest import wsgi_request
+    app = get_wsgi_application()
+    wsgi_request(app, "GET", "/query/")
+    milestone("first_response")
+
+    from bench.stub_dns import StubServer
+    server = StubServer().start()
+    settings.DNSQUERY_NAMESERVERS = ["127.0.0.1"]
+    settings.DNSQUERY_NAMESERVER_PORT = server.port
+    settings.DNSQUERY_NS_PROBE_PORT = server.port
+    if kind == "warmup":
+        time.sleep(idle)
+    from bench.fakes import ASNBackend, WhoisBackend, install
+    install(WhoisBackend(), ASNBackend())
+    start = time.perf_counter()
+    wsgi_request(app, "GET", "/query/api/v1/domain/example.com")
+    milestone("first_report", time.perf_counter() - start)
+    server.stop()
+
+
+def import_times(stderr):
+    # {phase: ms of top-level imports until its milestone}
+    times = dict.fromkeys(PHASES, 0.0)
+    phases = iter(PHASES)
+    phase = next(phases)
+    for line in stderr.splitlines():
+        if line.startswith("milestone "):
+            phase = next(phases, None)
+            if phase is None:
+                break
+            continue
+        match = IMPORT_LINE.match(line)
+        if match:
+            times[phase] += int(match.group(1)) / 1000
+    return times
+
+
+def measure(kind, idle):
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "-X", "importtime", os.path.abspath(__file__),
+         "--child", kind, "--idle", str(idle)],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, cwd=ROOT)
+    result = {}
+    for line in proc.stdout:
+        name, _, value = line.strip().partition(" ")
+        result[name] = float(value) * 1000 if value else (time.perf_counter() - start) * 1000
+    stderr = proc.stderr.read()
+    if proc.wait() != 0 or "first_report" not in result:
+        sys.exit("%s worker failed:\n%s" % (kind, stderr[-2000:]))
+    imports = import_times(stderr)
+    result["imports before"] = imports["first_response"]
+    result["imports in report"] = imports["first_report"]
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--kinds", default=",".join(KINDS))
+    parser.add_argument("--idle", type=float, default=1.0,
+                        help="seconds the warmup worker idles before its first report")
+    parser.add_argument("--child", choices=KINDS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.child, args.idle)
+        return
+
+    columns = ["first_response", "first_report", "imports before", "imports in report"]
+    print("median of %d runs, ms" % args.runs)
+    print("%-8s" % "worker" + "".join("%18s" % c for c in columns))
+    for kind in args.kinds.split(","):
+        runs = [measure(kind, args.idle) for _ in range(args.runs)]
+        print("%-8s" % kind + "".join("%18.1f" % statistics.median(r[c] for r in runs)
+                                      for c in columns))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,359 @@
+"""Local authoritative DNS stub for benchmarks.
+
+Serves fixture zones over UDP and TCP on 127.0.0.1 with an artificial
+per-query delay, so the report code can be timed without the internet.
+The zones' nameservers have loopback addresses, and the stub answers
+UDP on those too, at the same port, so the direct nameserver probe of
+a report (DNSQUERY_NS_PROBE_PORT) gets an answer.
+Queries pipelined on one TCP connection are answered as each comes due.
+Zones can be transferred with AXFR, and with IXFR from any serial they
+were served with before.  Reverse names outside the zones get a made-up
+PTR, so reports can sweep their addresses.  A share of the queries can be answered with
+SERVFAIL (--fail) or not at all (--drop) to see how the report copes
+with a failing upstream.
+"""
+import heapq
+import ipaddress
+import random
+import selectors
+import socket
+import struct
+import threading
+import time
+
+import dns.flags
+import dns.message
+import dns.name
+import dns.rcode
+import dns.rdatatype
+import dns.reversename
+import dns.rrset
+import dns.zone
+
+FIXTURE_ZONE = """
+$TTL 300
+@       IN SOA ns1.example.com. hostmaster.example.com. 2022081501 7200 3600 1209600 300
+@       IN NS ns1.example.com.
+@       IN NS ns2.example.com.
+@       IN A 192.0.2.10
+@       IN AAAA 2001:db8::10
+@       IN MX 0 example-com.mail.protection.outlook.com.
+@       IN TXT "v=spf1 include:spf.protection.outlook.com -all"
+ns1     IN A 127.0.53.1
+ns2     IN A 127.100.53.1
+www     IN A 192.0.2.10
+autodiscover IN CNAME autodiscover.outlook.com.
+msoid   IN CNAME clientconfig.microsoftonline-p.net.
+lyncdiscover IN CNAME webdir.online.lync.com.
+_sip._tls IN SRV 100 1 443 sipdir.online.lync.com.
+_sipfederationtls._tcp IN SRV 100 1 5061 sipfed.online.lync.com.
+"""
+
+REVERSE = dns.name.from_text("arpa.")
+
+
+def fixture_zone(domain, index=0):
+    # FIXTURE_ZONE for another domain, with nameservers in their own
+    # loopback /24s
+    text = FIXTURE_ZONE.replace("example.com", domain)
+    text = text.replace("127.0.53.1", "127.%d.%d.1" % (1 + index // 250, index % 250))
+    return text.replace("127.100.53.1", "127.%d.%d.1" % (101 + index // 250, index % 250))
+
+
+def nameserver_addresses(zone):
+    # the loopback IPv4 addresses of zone's own nameservers
+    found = set()
+    ns = zone.get_rdataset(zone.origin, dns.rdatatype.NS)
+    for rdata in ns or ():
+        a = zone.get_rdataset(rdata.target, dns.rdatatype.A) \
+            if rdata.target.is_subdomain(zone.origin) else None
+        found.update(str(r) for r in a or () if ipaddress.ip_address(str(r)).is_loopback)
+    return found
+
+
+def find_zone(zones, name):
+    while True:
+        if name in zones:
+            return zones[name]
+        if name == dns.name.root:
+            return None
+        name = name.parent()
+
+
+def answer(zone, query):
+    response = dns.message.make_response(query)
+    response.flags |= dns.flags.AA
+    question = query.question[0]
+    if zone is None or not question.name.is_subdomain(zone.origin):
+        response.set_rcode(dns.rcode.REFUSED)
+        return response
+    node = zone.get_node(question.name)
+    if node is None:
+        response.set_rcode(dns.rcode.NXDOMAIN)
+        return response
+    rdataset = node.get_rdataset(question.rdclass, question.rdtype)
+    if rdataset is None and question.rdtype != dns.rdatatype.CNAME:
+        rdataset = node.get_rdataset(question.rdclass, dns.rdatatype.CNAME)
+    if rdataset is None:
+        soa = zone.find_rdataset(zone.origin, dns.rdatatype.SOA)
+        rrset = response.find_rrset(response.authority, zone.origin,
+                                    soa.rdclass, soa.rdtype, create=True)
+        rrset.update(soa)
+        return response
+    rrset = response.find_rrset(response.answer, question.name,
+                                rdataset.rdclass, rdataset.rdtype, create=True)
+    rrset.update(rdataset)
+    return response
+
+
+def reverse_answer(query):
+    # ip-192-0-2-10.ptr.test. for 10.2.0.192.in-addr.arpa.
+    response = dns.message.make_response(query)
+    question = query.question[0]
+    try:
+        ip = dns.reversename.to_address(question.name)
+    except Exception:
+        response.set_rcode(dns.rcode.NXDOMAIN)
+        return response
+    if question.rdtype == dns.rdatatype.PTR:
+        target = "ip-%s.ptr.test." % ip.replace(".", "-").replace(":", "-")
+        response.answer.append(dns.rrset.from_text(question.name, 300, "IN", "PTR", target))
+    return response
+
+
+def zone_rrs(zone):
+    # {(name, ttl, rdata)} of zone, without its SOA
+    return {(name, ttl, rdata) for name, ttl, rdata in zone.iterate_rdatas()
+            if rdata.rdtype != dns.rdatatype.SOA}
+
+
+def soa_rrset(zone):
+    soa = zone.find_rdataset(zone.origin, dns.rdatatype.SOA)
+    return dns.rrset.from_rdata(zone.origin, soa.ttl, soa[0])
+
+
+def transfer(zone, versions, query):
+    # the AXFR answer, or the IXFR deltas from the serial in the query's
+    # authority section to zone; the whole zone when that serial is
+    # unknown
+    response = dns.message.make_response(query)
+    response.flags |= dns.flags.AA
+    question = query.question[0]
+    if zone is None or question.name != zone.origin:
+        response.set_rcode(dns.rcode.NOTAUTH)
+        return response
+    soa = soa_rrset(zone)
+    old = None
+    if question.rdtype == dns.rdatatype.IXFR and query.authority:
+        serial = query.authority[0][0].serial
+        if serial == soa[0].serial:
+            response.answer.append(soa)
+            return response
+        old = next((v for v in versions if soa_rrset(v)[0].serial == serial), None)
+    if old is None:
+        response.answer.append(soa)
+        for name, ttl, rdata in sorted(zone_rrs(zone), key=str):
+            response.answer.append(dns.rrset.from_rdata(name, ttl, rdata))
+        response.answer.append(soa)
+        return response
+    before, after = zone_rrs(old), zone_rrs(zone)
+    response.answer += [soa, soa_rrset(old)]
+    response.answer += [dns.rrset.from_rdata(*rr) for rr in sorted(before - after, key=str)]
+    response.answer.append(soa)
+    response.answer += [dns.rrset.from_rdata(*rr) for rr in sorted(after - before, key=str)]
+    response.answer.append(soa)
+    return response
+
+
+def recv_exactly(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+class TCPClient:
+    def __init__(self, sock):
+        self.sock = sock
+        self._lock = threading.Lock()
+
+    def send(self, response):
+        with self._lock:
+            self.sock.sendall(struct.pack("!H", len(response)) + response)
+
+
+class StubServer:
+    # one thread answers every query straight away; a second one holds
+    # each reply back until its --delay has passed, so slow upstreams
+    # cost no extra threads
+    def __init__(self, zone_text=FIXTURE_ZONE, origin="example.com",
+                 delay=0.0, port=0, fail=0.0, drop=0.0):
+        self.zones = {}
+        # {origin: [earlier versions of the zone]}, for IXFR
+        self.versions = {}
+        self.delay = delay
+        self.fail = fail
+        self.drop = drop
+        self.queries = 0
+        self.connections = 0
+        self._selector = selectors.DefaultSelector()
+        # {ip: UDP socket}; 127.0.0.1 first, then the nameserver addresses
+        self.udp = {}
+        self.sock = self._listen("127.0.0.1", port)
+        self.tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp.bind(("127.0.0.1", self.port))
+        self.tcp.listen(64)
+        self._replies = []
+        self._ready = threading.Condition()
+        self._running = False
+        self.add_zone(zone_text, origin)
+
+    def _listen(self, ip, port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+        sock.bind((ip, port))
+        self.udp[ip] = sock
+        self._selector.register(sock, selectors.EVENT_READ)
+        return sock
+
+    def add_zone(self, zone_text, origin):
+        # serves (or replaces) the zone of origin, on its nameservers'
+        # addresses too
+        zone = dns.zone.from_text(zone_text, origin, relativize=False)
+        if zone.origin in self.zones:
+            self.versions.setdefault(zone.origin, []).append(self.zones[zone.origin])
+        self.zones[zone.origin] = zone
+        for ip in nameserver_addresses(zone) - set(self.udp):
+            self._listen(ip, self.port)
+
+    @property
+    def port(self):
+        return self.sock.getsockname()[1]
+
+    def start(self):
+        self._running = True
+        threading.Thread(target=self._receive, daemon=True).start()
+        threading.Thread(target=self._send, daemon=True).start()
+        threading.Thread(target=self._accept, daemon=True).start()
+        return self
+
+    def serve_forever(self):
+        self.start()
+        while self._running:
+            time.sleep(1)
+
+    def stop(self):
+        self._running = False
+        with self._ready:
+            self._ready.notify()
+        for sock in self.udp.values():
+            sock.close()
+        self.tcp.close()
+
+    def reply(self, data):
+        query = dns.message.from_wire(data)
+        if self.fail and random.random() < self.fail:
+            response = dns.message.make_response(query)
+            response.set_rcode(dns.rcode.SERVFAIL)
+            return response.to_wire()
+        question = query.question[0]
+        if question.rdtype in (dns.rdatatype.AXFR, dns.rdatatype.IXFR):
+            zone = self.zones.get(question.name)
+            return transfer(zone, self.versions.get(question.name, []), query).to_wire()
+        zone = find_zone(self.zones, question.name)
+        if zone is None and question.name.is_subdomain(REVERSE):
+            return reverse_answer(query).to_wire()
+        return answer(zone, query).to_wire()
+
+    def _receive(self):
+        while self._running:
+            try:
+                ready = self._selector.select()
+            except (OSError, ValueError):
+                return
+            for key, _ in ready:
+                try:
+                    data, address = key.fileobj.recvfrom(4096)
+                except OSError:
+                    continue
+                self._queue(data, (key.fileobj, address))
+
+    def _accept(self):
+        while self._running:
+            try:
+                conn, _ = self.tcp.accept()
+            except OSError:
+                return
+            # pipelined replies are small; Nagle would hold them back
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self._ready:
+                self.connections += 1
+            threading.Thread(target=self._receive_tcp, args=(conn,), daemon=True).start()
+
+    def _receive_tcp(self, conn):
+        client = TCPClient(conn)
+        with conn:
+            while self._running:
+                try:
+                    header = recv_exactly(conn, 2)
+                    data = header and recv_exactly(conn, struct.unpack("!H", header)[0])
+                except OSError:
+                    return
+                if not data:
+                    return
+                self._queue(data, client)
+
+    def _queue(self, data, address):
+        # address is (UDP socket, peer) or the TCPClient of a connection
+        if self.drop and random.random() < self.drop:
+            with self._ready:
+                self.queries += 1
+            return
+        try:
+            response = self.reply(data)
+        except Exception:
+            return
+        with self._ready:
+            self.queries += 1
+            heapq.heappush(self._replies, (time.monotonic() + self.delay,
+                                           self.queries, response, address))
+            self._ready.notify()
+
+    def _send(self):
+        while self._running:
+            with self._ready:
+                while self._running and not self._replies:
+                    self._ready.wait()
+                if not self._replies:
+                    return
+                due, _, response, address = self._replies[0]
+                wait = due - time.monotonic()
+                if wait > 0:
+                    self._ready.wait(wait)
+                    continue
+                heapq.heappop(self._replies)
+            try:
+                if isinstance(address, TCPClient):
+                    address.send(response)
+                else:
+                    sock, peer = address
+                    sock.sendto(response, peer)
+            except OSError:
+                pass
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=5353)
+    parser.add_argument("--delay", type=float, default=0.0)
+    parser.add_argument("--fail", type=float, default=0.0)
+    parser.add_argument("--drop", type=float, default=0.0)
+    args = parser.parse_args()
+    server = StubServer(delay=args.delay, port=args.port, fail=args.fail, drop=args.drop)
+    print("serving example.com on 127.0.0.1:%d" % server.port)
+    server.serve_forever()
@@ -0,0 +1,194 @@
+"""Benchmark suite of the report pages against local fake upstreams.
+
+    python bench/suite.py --concurrency 1,10,50 --requests 200 --save base.json
+    python bench/suite.py --concurrency 1,10,50 --requests 200 --baseline base.json
+
+Serves --domains fixture zones from bench/stub_dns.py. WHOIS and IPASN
+are replaced by the stand-ins of bench/fakes.py. Each upstream has its
+own latency and failure share. Each scenario (search, whoisdetails,
+nsdetails, api, audit) runs at every --concurrency level: that many
+clients send requests back to back through the WSGI application, or,
+for audit, through the audit_domains batch path.
+
+The suite reports req/s, p50/p95/p99 latency and the DNS, WHOIS and
+IPASN calls per report. --cold turns off the DNS, WHOIS and ASN caches
+so every report pays for its lookups.
+
+--save writes the results as JSON. --baseline compares the run with a
+saved one and exits with status 1 if a scenario got slower or sent more
+upstream calls than --tolerance allows.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.fakes import ASNBackend, WhoisBackend, install
+from bench.loadtest import wsgi_request
+from bench.stub_dns import StubServer, fixture_zone
+
+SCENARIOS = ["search", "whoisdetails", "nsdetails", "api", "audit"]
+
+
+def percentile(values, share):
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+def request_for(scenario, domain):
+    if scenario == "search":
+        return "POST", "/query/search/", ("domain=%s" % domain).encode()
+    if scenario == "api":
+        return "GET", "/query/api/v1/domain/%s" % domain, b""
+    return "GET", "/query/search/%s/?domain=%s" % (scenario, domain), b""
+
+
+def run(scenario, app, domains, concurrency, total):
+    from query.management.commands.audit_domains import audit
+
+    def one(i):
+        domain = domains[i % len(domains)]
+        start = time.perf_counter()
+        # a report that raises (e.g. mid-stream) counts as an error
+        try:
+            if scenario == "audit":
+                ok = not audit(domain).get("error")
+            else:
+                ok = wsgi_request(app, *request_for(scenario, domain)) in (200, 304)
+        except Exception:
+            ok = False
+        return time.perf_counter() - start, ok
+
+    def client(indexes):
+        return [one(i) for i in indexes]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as clients:
+        results = [r for rs in clients.map(client, [range(c, total, concurrency)
+                                                    for c in range(concurrency)]) for r in rs]
+    elapsed = time.perf_counter() - start
+    latencies = sorted(r[0] for r in results)
+    errors = sum(1 for r in results if not r[1])
+    return {
+        "req/s": len(latencies) / elapsed,
+        "p50": percentile(latencies, 0.50) * 1000,
+        "p95": percentile(latencies, 0.95) * 1000,
+        "p99": percentile(latencies, 0.99) * 1000,
+        "errors": errors,
+    }
+
+
+def regressions(results, baseline, tolerance):
+    found = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        if result["p95"] > base["p95"] * (1 + tolerance):
+            found.append("%s: p95 %.1f ms, was %.1f ms" % (key, result["p95"], base["p95"]))
+        if result["req/s"] < base["req/s"] * (1 - tolerance):
+            found.append("%s: %.1f req/s, was %.1f" % (key, result["req/s"], base["req/s"]))
+        for upstream in ("dns", "whois", "asn"):
+            if result[upstream] > base[upstream] * (1 + tolerance) + 0.01:
+                found.append("%s: %.2f %s calls per report, was %.2f" % (
+                    key, result[upstream], upstream, base[upstream]))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", default="1,10,50",
+                        help="comma separated client counts")
+    parser.add_argument("--requests", type=int, default=200, help="requests per run")
+    parser.add_argument("--domains", type=int, default=20)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--delay", type=float, default=0.02, help="seconds per DNS query")
+    parser.add_argument("--whois-delay", type=float, default=0.1)
+    parser.add_argument("--asn-delay", type=float, default=0.05)
+    parser.add_argument("--dns-fail", type=float, default=0.0,
+                        help="share of DNS queries answered with SERVFAIL")
+    parser.add_argument("--whois-fail", type=float, default=0.0)
+    parser.add_argument("--asn-fail", type=float, default=0.0)
+    parser.add_argument("--transport", choices=["udp", "tcp"], default="udp",
+                        help="DNSQUERY_DNS_TRANSPORT of the run")
+    parser.add_argument("--cold", action="store_true", help="run without the caches")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON file of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    domains = ["site%d.test" % i for i in range(args.domains)]
+    server = StubServer(delay=args.delay, fail=args.dns_fail)
+    for i, domain in enumerate(domains):
+        server.add_zone(fixture_zone(domain, i), domain)
+    server.start()
+    whois_backend = WhoisBackend(args.whois_delay, args.whois_fail)
+    asn_backend = ASNBackend(args.asn_delay, args.asn_fail)
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "dnsquery.settings")
+    from django.conf import settings
+    settings.DNSQUERY_NAMESERVERS = ["127.0.0.1"]
+    settings.DNSQUERY_NAMESERVER_PORT = server.port
+    settings.DNSQUERY_NS_PROBE_PORT = server.port
+    settings.DNSQUERY_DNS_TRANSPORT = args.transport
+    settings.ALLOWED_HOSTS = ["127.0.0.1"]
+    settings.MIDDLEWARE = [m for m in settings.MIDDLEWARE if "Csrf" not in m]
+    if args.cold:
+        settings.DNSQUERY_CACHE_MAX_ENTRIES = 0
+        settings.DNSQUERY_WHOIS_TTL = 0
+        settings.DNSQUERY_ASN_TTL = 0
+    save = args.save and os.path.abspath(args.save)
+    baseline = args.baseline and os.path.abspath(args.baseline)
+    # a fresh query.db, and the mail_list.txt the checks read
+    workdir = tempfile.mkdtemp()
+    shutil.copy(os.path.join(ROOT, "mail_list.txt"), workdir)
+    os.chdir(workdir)
+
+    from django.core.wsgi import get_wsgi_application
+    app = get_wsgi_application()
+    install(whois_backend, asn_backend)
+
+    print("%d domains, %d requests per run, %s caches; DNS over %s %.0f ms, WHOIS %.0f ms, "
+          "IPASN %.0f ms" % (len(domains), args.requests, "without" if args.cold else "with",
+                             args.transport, args.delay * 1000, args.whois_delay * 1000,
+                             args.asn_delay * 1000))
+    print("%-14s %5s %8s %8s %8s %8s %6s %6s %6s %6s" % (
+        "scenario", "conc", "req/s", "p50 ms", "p95 ms", "p99 ms", "errors",
+        "dns", "whois", "asn"))
+    results = {}
+    for scenario in args.scenarios.split(","):
+        for concurrency in [int(c) for c in args.concurrency.split(",")]:
+            before = server.queries, whois_backend.calls, asn_backend.calls
+            result = run(scenario, app, domains, concurrency, args.requests)
+            result["dns"] = (server.queries - before[0]) / args.requests
+            result["whois"] = (whois_backend.calls - before[1]) / args.requests
+            result["asn"] = (asn_backend.calls - before[2]) / args.requests
+            results["%s@%d" % (scenario, concurrency)] = result
+            print("%-14s %5d %8.1f %8.1f %8.1f %8.1f %6d %6.2f %6.2f %6.2f" % (
+                scenario, concurrency, result["req/s"], result["p50"], result["p95"],
+                result["p99"], result["errors"], result["dns"], result["whois"], result["asn"]))
+    if args.transport != "udp":
+        print("%d DNS connections opened" % server.connections)
+    server.stop()
+
+    if save:
+        with open(save, "w") as f:
+            json.dump(results, f, indent=2)
+    if baseline:
+        with open(baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for line in found:
+            print("REGRESSION " + line)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Zone snapshots kept up to date by AXFR and IXFR from bench/stub_dns.py.
+
+    python bench/xfr.py --delay 0.2 --clients 8 --changes 5
+
+example.com is listed in DNSQUERY_XFR_ZONES with the stub as its
+primary, so the report lookups are answered from a snapshot.  --clients
+reports start at once on a cold snapshot and must share one AXFR, which
+costs --delay seconds.  Then the zone's serial is bumped --changes times
+with StubServer.add_zone, each time with a new www address, and the
+snapshot is refreshed: every refresh must be an IXFR, and the next
+report must see the new address without a DNS query.
+
+Exits with status 1 when one of those does not hold.
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import dns.name
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.stub_dns import FIXTURE_ZONE, StubServer
+
+DOMAIN = "example.com"
+SERIAL = 2022081501
+
+
+def zone_text(change):
+    # FIXTURE_ZONE with its serial and www address moved on by change
+    text = FIXTURE_ZONE.replace(str(SERIAL), str(SERIAL + change))
+    return text.replace("www     IN A 192.0.2.10", "www     IN A 192.0.2.%d" % (100 + change))
+
+
+def report(queries):
+    # one report's lookups, answered from the snapshot or sent upstream
+    from query.resolve import QueryPlan
+    plan = QueryPlan(use_cache=False)
+    for name, rdtype in queries:
+        plan.add(name, rdtype)
+    plan.resolve()
+    return plan
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--delay", type=float, default=0.2, help="seconds per stub answer")
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--changes", type=int, default=5)
+    args = parser.parse_args()
+
+    server = StubServer(delay=args.delay).start()
+    import django
+    from django.conf import settings
+    settings.configure(DNSQUERY_NAMESERVERS=["127.0.0.1"],
+                       DNSQUERY_NAMESERVER_PORT=server.port,
+                       DNSQUERY_XFR_ZONES={DOMAIN: ("127.0.0.1", server.port)},
+                       DNSQUERY_XFR_REFRESH=3600)
+    django.setup()
+    from query.checks import report_queries
+    from query.xfr import get_zones
+    queries = report_queries(DOMAIN)
+    snapshot = get_zones().find(dns.name.from_text(DOMAIN))
+    failed = []
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clients) as clients:
+        plans = list(clients.map(lambda _: report(queries), range(args.clients)))
+    elapsed = time.perf_counter() - start
+    transfers = server.queries
+    print("%d cold reports at once: %.0f ms, %d transfer(s), %d zone hits" % (
+        args.clients, elapsed * 1000, transfers, sum(p.stats["zone_hits"] for p in plans)))
+    if transfers != 1:
+        failed.append("%d transfers for the first snapshot" % transfers)
+
+    for change in range(1, args.changes + 1):
+        server.add_zone(zone_text(change), DOMAIN)
+        start = time.perf_counter()
+        how = snapshot.transfer()
+        elapsed = time.perf_counter() - start
+        plan = report([("www." + DOMAIN, "A")])
+        www = str(plan.get("www." + DOMAIN, "A")[0])
+        print("serial %d: %s in %.0f ms, www %s, %d DNS queries" % (
+            snapshot.serial, how, elapsed * 1000, www, plan.stats["dns_queries"]))
+        if how != "ixfr":
+            failed.append("change %d refreshed by %s" % (change, how))
+        if www != "192.0.2.%d" % (100 + change) or plan.stats["dns_queries"]:
+            failed.append("change %d: www %s after the refresh" % (change, www))
+    server.stop()
+
+    for line in failed:
+        print("FAILED " + line)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -122,3 +122,79 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/4.0/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# DNS resolution used by the query app, see query/upstreams.py
+# Leave DNSQUERY_NAMESERVERS empty to use the system resolv.conf; entries
+# are addresses or (address, port) pairs
+# A lookup is also sent to the next upstream once the first has taken
+# longer than DNSQUERY_DNS_HEDGE_PERCENTILE of its recent answers, and
+# gives up after DNSQUERY_DNS_TIMEOUT seconds
+
+DNSQUERY_NAMESERVERS = []
+DNSQUERY_NAMESERVER_PORT = 53
+DNSQUERY_RESOLVE_WORKERS = 16
+DNSQUERY_DNS_TIMEOUT = 2.0
+DNSQUERY_DNS_HEDGE_PERCENTILE = 0.9
+DNSQUERY_DNS_HEDGE_MIN = 0.01
+
+# "udp", or "tcp" / "tls" to pipeline every lookup over a few persistent
+# connections per upstream (query/pipeline.py); tls usually needs
+# DNSQUERY_NAMESERVER_PORT = 853, and without DNSQUERY_DNS_TLS_NAME the
+# upstream's certificate is not verified
+DNSQUERY_DNS_TRANSPORT = 'udp'
+DNSQUERY_DNS_CONNECTIONS = 2
+DNSQUERY_DNS_TLS_NAME = None
+
+# Zones we serve ourselves, answered from a zone transfer, see
+# query/xfr.py: origin -> primary that allows us AXFR and IXFR, as an
+# address or (address, port), e.g. {'example.com': '192.0.2.53'}
+DNSQUERY_XFR_ZONES = {}
+# Seconds between IXFR checks of the primary for a newer serial
+DNSQUERY_XFR_REFRESH = 60
+
+# DNS answer cache, see query/dnscache.py
+# Set DNSQUERY_CACHE_SHARED_PATH (e.g. BASE_DIR / 'dnscache.sqlite3') to
+# share cached answers between workers
+
+DNSQUERY_CACHE_MAX_ENTRIES = 10000
+DNSQUERY_CACHE_MAX_BYTES = 16 * 1024 * 1024
+DNSQUERY_CACHE_NEGATIVE_TTL = 300
+DNSQUERY_CACHE_SHARED_PATH = None
+
+# Threads the report views use for WHOIS, IPASN and SQLite calls
+DNSQUERY_BLOCKING_WORKERS = 64
+
+# How long a parsed WHOIS record is reused, in seconds
+DNSQUERY_WHOIS_TTL = 24 * 3600
+
+# How long an announced prefix -> ASN mapping is reused, in seconds
+DNSQUERY_ASN_TTL = 7 * 24 * 3600
+
+# Direct SOA/NS queries to every address of a domain's nameservers, see
+# query/nsprobe.py: seconds before a silent server counts as unreachable,
+# and the port they are sent to
+DNSQUERY_NS_PROBE_TIMEOUT = 1.0
+DNSQUERY_NS_PROBE_PORT = 53
+
+# Stored records of recently viewed domains kept in memory, see
+# query/snapshot.py; 0 turns the snapshots off
+DNSQUERY_SNAPSHOT_ENTRIES = 1000
+
+# MX host suffix -> mail provider list, reloaded when the file changes
+DNSQUERY_MAIL_LIST = 'mail_list.txt'
+
+# Warm a new worker up in the background after boot (upstream pool,
+# mail-provider table, SQLite schema, WHOIS and IPASN libraries), see
+# query/warmup.py
+DNSQUERY_WARMUP = False
+
+# Background refresh of the domains in query.db, see query/prefetch.py
+# Set DNSQUERY_PREFETCH_THREAD to run it inside the web process instead of
+# with manage.py prefetch_domains
+DNSQUERY_PREFETCH_THREAD = False
+DNSQUERY_PREFETCH_CONCURRENCY = 4
+DNSQUERY_PREFETCH_DNS_RATE = 20
+DNSQUERY_PREFETCH_WHOIS_RATE = 0.5
+DNSQUERY_PREFETCH_ASN_RATE = 1
+DNSQUERY_PREFETCH_AHEAD = 0.1
@@ -1,6 +1,15 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class QueryConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'query'
+
+    def ready(self):
+        if getattr(settings, "DNSQUERY_PREFETCH_THREAD", False):
+            from . import prefetch
+            prefetch.start()
+        if getattr(settings, "DNSQUERY_WARMUP", False):
+            from . import warmup
+            warmup.start()
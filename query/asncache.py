@@ -0,0 +1,160 @@
+"""IP -> ASN lookups cached per announced prefix.
+
+An IPASN answer covers the whole prefix it was announced in (asn_cidr),
+so it is stored under that prefix and any later IP inside it is answered
+from memory by longest-prefix match.  Prefixes expire after
+DNSQUERY_ASN_TTL seconds.  The asn_prefixes table of query.db keeps them
+across restarts and shares them between workers; ``manage.py
+preload_asn`` fills it from an offline prefix -> ASN dump.
+"""
+import ipaddress
+import threading
+import time
+from datetime import datetime
+
+from django.conf import settings
+
+from . import metrics, store
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+class PrefixTable:
+    # {version: {prefixlen: {network address as int: entry}}}; a lookup
+    # probes the populated prefix lengths from longest to shortest
+    def __init__(self):
+        self._prefixes = {4: {}, 6: {}}
+        self._lengths = {4: [], 6: []}
+
+    def __len__(self):
+        return sum(len(nets) for by_len in self._prefixes.values() for nets in by_len.values())
+
+    def add(self, network, entry):
+        by_len = self._prefixes[network.version]
+        if network.prefixlen not in by_len:
+            by_len[network.prefixlen] = {}
+            self._lengths[network.version] = sorted(by_len, reverse=True)
+        by_len[network.prefixlen][int(network.network_address)] = entry
+
+    def remove(self, network):
+        self._prefixes[network.version].get(network.prefixlen, {}).pop(
+            int(network.network_address), None)
+
+    def match(self, ip):
+        # (network, entry) of the longest prefix containing ip, or None
+        ip = ipaddress.ip_address(ip)
+        bits = ip.max_prefixlen
+        value = int(ip)
+        by_len = self._prefixes[ip.version]
+        for prefixlen in self._lengths[ip.version]:
+            key = value >> (bits - prefixlen) << (bits - prefixlen)
+            entry = by_len[prefixlen].get(key)
+            if entry is not None:
+                return ipaddress.ip_network((key, prefixlen)), entry
+        return None
+
+
+class ASNCache:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.table = PrefixTable()
+        self.synced = 0
+        self._lock = threading.Lock()
+
+    def sync(self):
+        # pick up prefixes other workers (or preload_asn) have written
+        for row in store.load_prefixes(store.connect(), self.synced):
+            rowid, prefix, asn, country, registry, description, fetched_at = row
+            self.synced = rowid
+            expires = datetime.fromisoformat(fetched_at).timestamp() + self.ttl
+            if expires > time.time():
+                self.table.add(ipaddress.ip_network(prefix), {
+                    "asn": asn, "asn_cidr": prefix, "asn_country_code": country,
+                    "asn_registry": registry, "asn_description": description,
+                    "expires": expires,
+                })
+
+    def get(self, ip):
+        with self._lock:
+            found = self.table.match(ip)
+            if found is None:
+                self.sync()
+                found = self.table.match(ip)
+            if found is None:
+                return None
+            network, entry = found
+            if entry["expires"] <= time.time():
+                self.table.remove(network)
+                return None
+            return entry
+
+    def put(self, rows):
+        # rows of (prefix, asn, country, registry, description)
+        fetched_at = store.now()
+        store.save_prefixes(store.connect(), [row + (fetched_at,) for row in rows])
+        with self._lock:
+            self.sync()
+
+
+def get_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ASNCache(getattr(settings, "DNSQUERY_ASN_TTL", 7 * 24 * 3600))
+        return _cache
+
+
+def announced_prefix(ip, cidr):
+    # IPASN may give no CIDR, or several; fall back to the single address
+    for candidate in str(cidr or "").split(","):
+        try:
+            network = ipaddress.ip_network(candidate.strip())
+        except ValueError:
+            continue
+        if ipaddress.ip_address(ip) in network:
+            return str(network)
+    return str(ipaddress.ip_network(ip))
+
+
+def lookup(ip, stats=None, limiter=None):
+    cache = get_cache()
+    entry = cache.get(ip)
+    if entry is not None:
+        if stats is not None:
+            stats.add("asn_cache_hits")
+        return entry
+    # ipwhois is imported on the first lookup that misses the cache
+    from ipwhois.asn import IPASN
+    from ipwhois.net import Net
+    # Net raises IPDefinedError for private-use addresses before any query
+    net = Net(ip)
+    if stats is not None:
+        stats.add("asn_lookups")
+    if limiter is not None:
+        limiter.acquire()
+    with metrics.span("ipasn_query"):
+        results = IPASN(net).lookup()
+    cache.put([(announced_prefix(ip, results["asn_cidr"]), results["asn"],
+                results["asn_country_code"], results["asn_registry"],
+                results["asn_description"])])
+    return results
+
+
+def preload(lines):
+    # "prefix asn [country registry description...]" per line, as in the
+    # usual prefix -> ASN dumps; '#' starts a comment
+    rows = []
+    for line in lines:
+        fields = line.split("#")[0].split()
+        if len(fields) < 2:
+            continue
+        prefix = str(ipaddress.ip_network(fields[0], strict=False))
+        asn = fields[1].upper().replace("AS", "")
+        country = fields[2] if len(fields) > 2 else None
+        registry = fields[3] if len(fields) > 3 else None
+        description = " ".join(fields[4:]) or None
+        rows.append((prefix, asn, country, registry, description))
+    if rows:
+        get_cache().put(rows)
+    return len(rows)
@@ -0,0 +1,470 @@
+"""The checks behind a domain report.
+
+Every check reads its lookups from the ReportContext of the report, so
+the search view and the audit_domains command produce the same results.
+"""
+import re
+
+import dns.exception
+import dns.name
+import dns.resolver
+import dns.reversename
+
+from . import mailproviders, metrics, nsprobe, store
+from .report import ASN_FIELDS
+
+RECORD_TYPES = list(store.ZONE_TYPES)
+O365_QUERIES = [
+    ("autodiscover.", "CNAME"),
+    ("msoid.", "CNAME"),
+    ("lyncdiscover.", "CNAME"),
+    ("_sip._tls.", "SRV"),
+    ("_sipfederationtls._tcp.", "SRV"),
+]
+HOST_TYPES = ["A", "AAAA"]
+# lookups no upstream answered, as opposed to a negative answer
+UNANSWERED = (dns.exception.Timeout, dns.resolver.NoNameservers)
+
+
+def valid_domain(domain):
+    # False for a name no lookup can be sent for: empty or the root, an
+    # empty label, a label over 63 octets or a name over 255
+    try:
+        name = dns.name.from_text(store.domain_key(domain))
+    except dns.exception.DNSException:
+        return False
+    return name != dns.name.root
+
+
+def domain_exists(ctx):
+    # False when the domain is NXDOMAIN; a missing or unanswered apex A is
+    # left for the checks, which show which of their own lookups went
+    # unanswered
+    try:
+        ctx.resolve(ctx.domain, "A")
+    except dns.resolver.NXDOMAIN:
+        return False
+    except (dns.resolver.NoAnswer,) + UNANSWERED:
+        pass
+    return True
+
+
+def report_queries(domain):
+    queries = [(domain, rdtype) for rdtype in RECORD_TYPES]
+    queries += [(prefix+domain, rdtype) for prefix, rdtype in O365_QUERIES]
+    queries.append(("www."+domain, "A"))
+    return queries
+
+
+def plan_nameservers(ctx):
+    try:
+        for data in ctx.resolve(ctx.domain, "NS"):
+            for rdtype in HOST_TYPES:
+                ctx.plan.add(str(data), rdtype)
+    except Exception:
+        pass
+
+
+def answers(ctx, name, rdtype):
+    try:
+        return list(ctx.resolve(name, rdtype))
+    except Exception:
+        return []
+
+
+def report_hosts(ctx):
+    # the apex, its nameservers and its MX hosts
+    hosts = [ctx.domain]
+    hosts += [str(data) for data in answers(ctx, ctx.domain, "NS")]
+    hosts += [str(data.exchange) for data in answers(ctx, ctx.domain, "MX")
+              if str(data.exchange) != "."]
+    return hosts
+
+
+def plan_hosts(ctx):
+    for host in report_hosts(ctx)[1:]:
+        for rdtype in HOST_TYPES:
+            ctx.plan.add(host, rdtype)
+
+
+def plan_report(ctx):
+    # every lookup the report needs, resolved concurrently in two rounds:
+    # the zone itself first, then the addresses of its nameservers and MX
+    # hosts; the PTR section sweeps their reverse names itself
+    with metrics.span("dns"):
+        for name, rdtype in report_queries(ctx.domain):
+            ctx.plan.add(name, rdtype)
+        ctx.plan.resolve()
+        plan_hosts(ctx)
+        ctx.plan.resolve()
+    return ctx
+
+
+async def plan_report_async(ctx):
+    with metrics.span("dns"):
+        for name, rdtype in report_queries(ctx.domain):
+            ctx.plan.add(name, rdtype)
+        await ctx.plan.resolve_async()
+        plan_hosts(ctx)
+        await ctx.plan.resolve_async()
+    return ctx
+
+
+def host_addresses(ctx):
+    # (host, ip) of every address of the apex, nameservers and MX hosts
+    rows = []
+    for host in report_hosts(ctx):
+        for rdtype in HOST_TYPES:
+            for data in answers(ctx, host, rdtype):
+                rows.append((host.rstrip("."), str(data)))
+    return rows
+
+
+def plan_ptrs(plan, ips):
+    for ip in ips:
+        plan.add(dns.reversename.from_address(ip), "PTR")
+
+
+def ptr_name(plan, ip):
+    # the reverse names of ip, "none" or "timeout"
+    try:
+        ptr = plan.get(dns.reversename.from_address(ip), "PTR")
+    except UNANSWERED:
+        return "timeout"
+    except Exception:
+        return "none"
+    return ", ".join(str(data).rstrip(".") for data in ptr)
+
+
+def ptr_rows(plan, addresses):
+    return [{"host": host, "ip": ip, "ptr": ptr_name(plan, ip)} for host, ip in addresses]
+
+
+@metrics.timed("ptr_sweep")
+def sweep_ptrs(plan, ips):
+    # every PTR lookup at once; answers come from the DNS answer cache
+    # when another report swept the same IP
+    plan_ptrs(plan, ips)
+    plan.resolve()
+
+
+def collect_records(ctx):
+    # the (record_type, record_value) rows stored for a domain; WHOIS
+    # is cached on its own, see whoiscache
+    return zone_records(ctx) + asn_records(ctx)
+
+
+def zone_records(ctx):
+    # trivial records; a type whose lookup went unanswered is left out
+    # so its stored rows are kept instead of replaced with "none"
+    rows = []
+    for x in RECORD_TYPES:
+        try:
+            values = record_search(ctx, x)
+        except UNANSWERED:
+            continue
+        for value in values:
+            rows.append((x, value))
+    return rows
+
+
+def asn_records(ctx):
+    rows = []
+    as_records = ctx.as_records()
+    for x in ASN_FIELDS:
+        if as_records in ("private_error", "lookup_error"):
+            rows.append((x, as_records))
+        else:
+            for value in as_records[x]:
+                rows.append((x, value))
+    return rows
+
+
+def database_search(stored, type):
+    result = []
+    for value in stored.get(type, []):
+        if str(value) == "none":
+            return "none"
+        elif str(value) in ("private_error", "lookup_error"):
+            return str(value)
+        else:
+            result.append(value)
+    return result
+
+
+def records_section(ctx, stored):
+    return {
+        "a": database_search(stored, "A"),
+        "aaaa": database_search(stored, "AAAA"),
+        "ns": database_search(stored, "NS"),
+        "mx": database_search(stored, "MX"),
+        "txt": database_search(stored, "TXT"),
+        "soa": database_search(stored, "SOA"),
+        "www": www_check(ctx),
+        "wans": "http://www."+ctx.domain,
+    }
+
+
+def registrar_section(ctx, stored):
+    return {
+        "registrar": regi_search(ctx.whois()),
+        "exp_date": exp_date(ctx.whois()),
+    }
+
+
+def asn_section(ctx, stored):
+    if not stored.get("ip") and ctx.as_records() == "lookup_error":
+        # the lookup failed and there are no older rows to show
+        stored = store.group(asn_records(ctx))
+    return {
+        "ip": database_search(stored, "ip"),
+        "asn": database_search(stored, "asn"),
+        "country": database_search(stored, "country"),
+        "registry": database_search(stored, "registry"),
+        "description": database_search(stored, "description"),
+    }
+
+
+def whois_ns_section(ctx, stored):
+    return {"whois_ns": whois_ns_compare(ctx)}
+
+
+def ns_ip_section(ctx, stored):
+    return {"ns_ip": ns_ip_compare(stored.get("ip", []))}
+
+
+def ns_auth_section(ctx, stored):
+    servers = ctx.ns_probe()
+    return {"ns_auth": servers, "ns_auth_check": nsprobe.verdict(servers)}
+
+
+def ptr_section(ctx, stored):
+    addresses = host_addresses(ctx)
+    sweep_ptrs(ctx.plan, {ip for _, ip in addresses})
+    return {"ptr": ptr_rows(ctx.plan, addresses)}
+
+
+def mail_section(ctx, stored):
+    return {
+        "mail_search": mail_search(ctx, "search"),
+        "auto": o365check(ctx, "auto"),
+        "msoid": o365check(ctx, "msoid"),
+        "lync": o365check(ctx, "lync"),
+        "365mx": o365check(ctx, "365mx"),
+        "spf": o365check(ctx, "spf"),
+        "sipdir": o365check(ctx, "sipdir"),
+        "sipfed": o365check(ctx, "sipfed"),
+    }
+
+
+# the sections of ans.html in page order; each renders
+# templates/report/<name>.html from the dict its function returns
+SECTIONS = [
+    ("records", records_section),
+    ("registrar", registrar_section),
+    ("asn", asn_section),
+    ("whois_ns", whois_ns_section),
+    ("ns_ip", ns_ip_section),
+    ("ns_auth", ns_auth_section),
+    ("ptr", ptr_section),
+    ("mail", mail_section),
+]
+
+
+def build_report(ctx, stored, sections=SECTIONS):
+    # stored holds the domain's records as {record_type: [values]}
+    report = {"domain": ctx.domain}
+    for _, section in sections:
+        report.update(section(ctx, stored))
+    return report
+
+
+@metrics.timed("record_search")
+def record_search(ctx, type):
+    record = []
+    try:
+        q = ctx.resolve(ctx.domain, type)
+        for data in q:
+            record.append(str(data))
+    except UNANSWERED:
+        raise
+    except Exception:
+        record.append("none")
+    return record
+
+
+@metrics.timed("whois_ns_compare")
+def whois_ns_compare(ctx):
+    record = ctx.whois()
+    if record.failed():
+        return "whois_timeout"
+    x = set(record.name_servers)
+    y = []
+    try:
+        ns = ctx.resolve(ctx.domain, "NS")
+    except UNANSWERED:
+        return "timeout"
+    for data in ns:
+        data = re.sub(r"\.$", "", str(data))
+        y.append(str(data))
+    y = set(y)
+    joined = x.union(y)
+    if len(joined) != len(x):
+        return "misconfigured"
+    elif len(joined) != len(y):
+        return "misconfigured"
+    else:
+        return "correct"
+
+
+def ns_ip_compare(ip):
+    if len(ip) == 1:
+        return "correct"
+    try:
+        ip_set = set()
+        for num in ip:
+            string = re.sub(r".\d+$", "", str(num))
+            ip_set.add(string)
+        if len(ip_set) != len(ip):
+            return "misconfigured"
+        else:
+            return "correct"
+    except Exception:
+        return "none"
+
+
+def regi_search(record):
+    if record.failed():
+        return "timeout"
+    if record.registrar:
+        return record.registrar.upper()
+    return "none"
+
+
+def exp_date(record):
+    if record.failed():
+        return "timeout"
+    if record.expiration_date:
+        return record.expiration_date
+    return "none"
+
+
+@metrics.timed("o365check")
+def o365check(ctx, type):
+    domain = ctx.domain
+    if type == "auto":
+        try:
+            cname = ctx.resolve("autodiscover."+domain, "CNAME")
+            for data in cname:
+                if re.search(r"autodiscover.outlook.com", str(data)):
+                    return "correct"
+                else:
+                    return "misconfigured"
+        except UNANSWERED:
+            return "timeout"
+        except Exception:
+            return "misconfigured"
+    if type == "msoid":
+        try:
+            cname = ctx.resolve("msoid."+domain, "CNAME")
+            for data in cname:
+                if re.search(r"clientconfig.microsoftonline-p.net", str(data)):
+                    return "correct"
+                else:
+                    pass
+        except UNANSWERED:
+            return "timeout"
+        except Exception:
+            pass
+    if type == "lync":
+        try:
+            cname = ctx.resolve("lyncdiscover."+domain, "CNAME")
+            for data in cname:
+                if re.search(r"webdir.online.lync.com", str(data)):
+                    return "correct"
+                else:
+                    pass
+        except UNANSWERED:
+            return "timeout"
+        except Exception:
+            pass
+    if type == "365mx":
+        try:
+            ans = 0
+            mx = ctx.resolve(domain, "MX")
+            for data in mx:
+                if re.search(r"mail.protection.outlook.com", str(data)):
+                    ans = 1
+                    return "correct"
+                    break
+                elif re.search(r"protection.outlook.com", str(data)):
+                    ans = 1
+                    return "update"
+                    break
+                else:
+                    pass
+            if ans != 1:
+                return "misconfigured"
+        except UNANSWERED:
+            return "timeout"
+        except Exception:
+            return "misconfigured"
+    if type == "spf":
+        try:
+            ans = 0
+            spf = ctx.resolve(domain, "txt")
+            for data in spf:
+                if re.search(r"include:spf.protection.outlook.com", str(data)):
+                    ans = 1
+                    return "correct"
+                    break
+                else:
+                    pass
+            if ans != 1:
+                return "misconfigured"
+        except UNANSWERED:
+            return "timeout"
+        except Exception:
+            return "misconfigured"
+    if type == "sipdir":
+        try:
+            tls = ctx.resolve("_sip._tls."+domain, "SRV")
+            if tls:
+                return "correct"
+        except UNANSWERED:
+            return "timeout"
+        except Exception:
+            return "misconfigured"
+    if type == "sipfed":
+        try:
+            tcp = ctx.resolve("_sipfederationtls._tcp."+domain, "SRV")
+            if tcp:
+                return "correct"
+        except UNANSWERED:
+            return "timeout"
+        except Exception:
+            return "misconfigured"
+
+@metrics.timed("mail_search")
+def mail_search(ctx, type):
+    if type == "search":
+        try:
+            mx = ctx.resolve(ctx.domain, "MX")
+        except dns.resolver.NoAnswer:
+            return "misconfigured"
+        except UNANSWERED:
+            return "timeout"
+        return mailproviders.provider(mx) or "misconfigured"
+
+
+@metrics.timed("www_check")
+def www_check(ctx):
+    domain = ctx.domain
+    try:
+        a = ctx.resolve("www."+domain, "A")
+        if a:
+            return "correct"
+    except UNANSWERED:
+        return "timeout"
+    except Exception:
+        return "none"
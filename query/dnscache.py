@@ -0,0 +1,243 @@
+"""Process-wide DNS answer cache.
+
+Answers are keyed by (qname, rdtype) and kept for the TTL of their
+RRset.  NXDOMAIN and NoAnswer are cached negatively for the SOA minimum
+of the response (or DNSQUERY_CACHE_NEGATIVE_TTL), as a Negative that
+every hit raises as a new exception.  The in-process LRU is capped by
+entry count and by an estimate of its size in bytes.
+
+With DNSQUERY_CACHE_SHARED_PATH set, entries are also written to a
+SQLite file so every worker on the host can serve them.
+"""
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+
+import dns.name
+import dns.rdatatype
+import dns.resolver
+import dns.rrset
+from django.conf import settings
+
+NEGATIVE_ERRORS = (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer)
+ENTRY_OVERHEAD = 200
+PURGE_EVERY = 1000
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+class Negative:
+    # a cached NXDOMAIN or NoAnswer.  The exception itself is not kept:
+    # each raise of a shared one would add to its traceback, and with it
+    # keep the frames of every request alive
+    __slots__ = ("kind", "ttl", "response")
+
+    def __init__(self, kind, ttl, response=None):
+        self.kind = kind
+        self.ttl = ttl
+        self.response = response
+
+    def error(self, qname):
+        if self.kind == "nxdomain":
+            name = dns.name.from_text(qname)
+            responses = {name: self.response} if self.response is not None else {}
+            return dns.resolver.NXDOMAIN(qnames=[name], responses=responses)
+        if self.response is None:
+            return dns.resolver.NoAnswer()
+        return dns.resolver.NoAnswer(response=self.response)
+
+
+def negative(exc, default_ttl):
+    # the Negative for an NXDOMAIN or NoAnswer exception
+    if isinstance(exc, dns.resolver.NXDOMAIN):
+        kind = "nxdomain"
+        response = next(iter(exc.kwargs.get("responses", {}).values()), None)
+    else:
+        kind = "noanswer"
+        response = exc.kwargs.get("response")
+    return Negative(kind, negative_ttl(exc, default_ttl), response)
+
+
+def entry_size(key, value):
+    if isinstance(value, Negative):
+        return ENTRY_OVERHEAD + len(key[0])
+    return ENTRY_OVERHEAD + len(key[0]) + sum(len(rdata.to_text()) for rdata in value)
+
+
+def negative_ttl(exc, default):
+    if isinstance(exc, dns.resolver.NXDOMAIN):
+        responses = list(exc.kwargs.get("responses", {}).values())
+    else:
+        responses = [exc.kwargs.get("response")]
+    for response in responses:
+        if response is None:
+            continue
+        for rrset in response.authority:
+            if rrset.rdtype == dns.rdatatype.SOA:
+                return min(rrset.ttl, rrset[0].minimum, default)
+    return default
+
+
+class SQLiteBackend:
+    # shared between the workers of one host; a plain file keeps the
+    # deployment free of extra services
+    def __init__(self, path):
+        self.path = str(path)
+        self._local = threading.local()
+        self.connection().execute("""CREATE TABLE IF NOT EXISTS dnscache (
+                                         qname text,
+                                         rdtype text,
+                                         expires real,
+                                         kind text,
+                                         payload text,
+                                         PRIMARY KEY (qname, rdtype)
+                                     )""")
+
+    def connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key, now):
+        row = self.connection().execute(
+            "SELECT expires, kind, payload FROM dnscache WHERE qname=? AND rdtype=?",
+            key).fetchone()
+        if row is None or row[0] <= now:
+            return None
+        expires, kind, payload = row
+        ttl = max(0, int(expires - now))
+        if kind in ("nxdomain", "noanswer"):
+            value = Negative(kind, ttl)
+        else:
+            value = dns.rrset.from_text_list(key[0], ttl, "IN", key[1],
+                                             payload.split("\n"))
+        return expires, value
+
+    def put(self, key, expires, value):
+        if isinstance(value, Negative):
+            kind, payload = value.kind, ""
+        else:
+            kind = "rrset"
+            payload = "\n".join(rdata.to_text() for rdata in value)
+        self.connection().execute(
+            "INSERT OR REPLACE INTO dnscache VALUES (?, ?, ?, ?, ?)",
+            (key[0], key[1], expires, kind, payload))
+
+    def purge(self, now):
+        self.connection().execute("DELETE FROM dnscache WHERE expires <= ?", (now,))
+
+
+class DNSCache:
+    def __init__(self, max_entries=10000, max_bytes=16 * 1024 * 1024,
+                 negative_ttl=300, backend=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.negative_ttl = negative_ttl
+        self.backend = backend
+        self.counters = Counter()
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, now=None):
+        # (True, rrset-or-Negative) on a hit, (False, None) on a miss
+        now = time.time() if now is None else now
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self.counters["hits"] += 1
+                    if isinstance(entry[1], Negative):
+                        self.counters["negative_hits"] += 1
+                    return True, entry[1]
+                self._remove(key)
+                self.counters["expired"] += 1
+        if self.backend is not None:
+            shared = self.backend.get(key, now)
+            if shared is not None:
+                with self._lock:
+                    self._store(key, *shared)
+                    self.counters["shared_hits"] += 1
+                return True, shared[1]
+        with self._lock:
+            self.counters["misses"] += 1
+        return False, None
+
+    def put(self, key, value, now=None):
+        now = time.time() if now is None else now
+        if isinstance(value, NEGATIVE_ERRORS):
+            value = negative(value, self.negative_ttl)
+        elif isinstance(value, Exception):
+            return
+        ttl = value.ttl
+        if ttl <= 0 or self.max_entries <= 0:
+            return
+        expires = now + ttl
+        with self._lock:
+            self._store(key, expires, value)
+            self.counters["stores"] += 1
+            purge = self.counters["stores"] % PURGE_EVERY == 0
+        if self.backend is not None:
+            self.backend.put(key, expires, value)
+            if purge:
+                self.backend.purge(now)
+
+    def ttl(self, key, now=None):
+        # seconds the cached answer for key stays valid, or None
+        now = time.time() if now is None else now
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return None
+        return max(0, int(entry[0] - now))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats.update(entries=len(self._entries), bytes=self.size,
+                         max_entries=self.max_entries, max_bytes=self.max_bytes)
+        lookups = stats.get("hits", 0) + stats.get("shared_hits", 0) + stats.get("misses", 0)
+        stats["hit_ratio"] = (lookups - stats.get("misses", 0)) / lookups if lookups else 0.0
+        return stats
+
+    def _store(self, key, expires, value):
+        if key in self._entries:
+            self._remove(key)
+        size = entry_size(key, value)
+        self._entries[key] = (expires, value, size)
+        self.size += size
+        while self._entries and (len(self._entries) > self.max_entries
+                                 or self.size > self.max_bytes):
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.counters["evictions"] += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.size -= entry[2]
+
+
+def get_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            path = getattr(settings, "DNSQUERY_CACHE_SHARED_PATH", None)
+            _cache = DNSCache(
+                max_entries=getattr(settings, "DNSQUERY_CACHE_MAX_ENTRIES", 10000),
+                max_bytes=getattr(settings, "DNSQUERY_CACHE_MAX_BYTES", 16 * 1024 * 1024),
+                negative_ttl=getattr(settings, "DNSQUERY_CACHE_NEGATIVE_TTL", 300),
+                backend=SQLiteBackend(path) if path else None,
+            )
+        return _cache
@@ -0,0 +1,79 @@
+"""Mail provider classification of MX hosts.
+
+mail_list.txt has one "host-suffix provider" pair per line.  It is
+parsed once into a trie of reversed labels, and parsed again only when
+its mtime changes.  A host is classified by walking its labels from the
+right; the longest listed suffix wins.
+"""
+import os
+import threading
+
+from django.conf import settings
+
+_table = None
+_mtime = None
+_lock = threading.Lock()
+
+
+def host_key(host):
+    return str(host).strip().rstrip(".").lower()
+
+
+class ProviderTable:
+    def __init__(self, pairs=()):
+        # {label: {label: ..., None: provider}}, rightmost label first
+        self.root = {}
+        for suffix, provider in pairs:
+            node = self.root
+            for label in reversed(host_key(suffix).split(".")):
+                node = node.setdefault(label, {})
+            node[None] = provider
+
+    def classify(self, host):
+        # the provider of the longest listed suffix of host, or None
+        node = self.root
+        provider = None
+        for label in reversed(host_key(host).split(".")):
+            node = node.get(label)
+            if node is None:
+                break
+            provider = node.get(None, provider)
+        return provider
+
+
+def parse(lines):
+    pairs = []
+    for line in lines:
+        fields = line.split()
+        if len(fields) >= 2:
+            pairs.append((fields[0], fields[1]))
+    return ProviderTable(pairs)
+
+
+def get_table(path=None):
+    global _table, _mtime
+    if path is None:
+        path = getattr(settings, "DNSQUERY_MAIL_LIST", "mail_list.txt")
+    mtime = os.stat(path).st_mtime_ns
+    with _lock:
+        if _table is None or mtime != _mtime:
+            with open(path, "r", encoding="utf-8") as f:
+                _table = parse(f)
+            _mtime = mtime
+        return _table
+
+
+def classify_mx(rrset, table=None):
+    # [(preference, host, provider or None)] for every MX of rrset,
+    # most preferred first
+    table = table or get_table()
+    hosts = sorted((rdata.preference, host_key(rdata.exchange)) for rdata in rrset)
+    return [(preference, host, table.classify(host)) for preference, host in hosts]
+
+
+def provider(rrset, table=None):
+    # the provider of the most preferred MX host that has a known one
+    for _, _, name in classify_mx(rrset, table):
+        if name is not None:
+            return name
+    return None
@@ -0,0 +1,140 @@
+import asyncio
+import csv
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.core.management.base import BaseCommand
+
+from query import checks, store
+from query.report import ReportContext
+from query.resolve import QueryPlan, RateLimiter
+from query.upstreams import get_pool
+
+COLUMNS = ["domain", "error", "a", "aaaa", "ns", "mx", "txt", "soa", "whois_ns", "ns_ip",
+           "ns_auth", "ns_auth_check", "ptr", "ip", "asn", "country", "registry", "description",
+           "registrar", "exp_date", "auto", "msoid", "lync", "365mx", "spf", "sipdir", "sipfed",
+           "mail_search", "www"]
+# a batch sweeps its PTRs together, see sweep_batch
+BATCH_SECTIONS = [(name, section) for name, section in checks.SECTIONS if name != "ptr"]
+
+
+def read_domains(source):
+    seen = set()
+    for line in source:
+        domain = store.domain_key(line.split("#")[0].strip())
+        if domain and domain not in seen:
+            seen.add(domain)
+            yield domain
+
+
+def audit(domain, batched=False):
+    # a batched report carries the (host, ip) rows of its PTR section,
+    # for sweep_batch to fill in
+    ctx = checks.plan_report(ReportContext(domain))
+    if not checks.domain_exists(ctx):
+        return {"domain": domain, "error": "NXDOMAIN"}
+    stored = store.group(checks.collect_records(ctx))
+    if batched:
+        report = checks.build_report(ctx, stored, BATCH_SECTIONS)
+        report["ptr"] = checks.host_addresses(ctx)
+    else:
+        report = checks.build_report(ctx, stored)
+    report.pop("wans")
+    report["stats"] = dict(ctx.stats)
+    return report
+
+
+def sweep_batch(reports, concurrency):
+    # the PTRs of every report in the batch as one concurrent sweep on an
+    # event loop, each IP looked up once
+    plan = QueryPlan(max_workers=concurrency)
+    batched = [report for report in reports if "ptr" in report]
+    checks.plan_ptrs(plan, {ip for report in batched for _, ip in report["ptr"]})
+    asyncio.run(plan.resolve_async())
+    for report in batched:
+        report["ptr"] = checks.ptr_rows(plan, report["ptr"])
+    return plan.stats
+
+
+class Command(BaseCommand):
+    help = "Run the search checks over a list of domains and stream the results"
+
+    def add_arguments(self, parser):
+        parser.add_argument("source", nargs="?", default="-",
+                            help="file with one domain per line, '-' for stdin")
+        parser.add_argument("--concurrency", type=int, default=8,
+                            help="domains audited at the same time")
+        parser.add_argument("--rate", type=float, default=50,
+                            help="DNS queries per second sent to each upstream resolver")
+        parser.add_argument("--format", choices=["jsonl", "csv"], default="jsonl")
+        parser.add_argument("--batch", type=int, default=0,
+                            help="sweep the PTRs of this many domains together, writing "
+                                 "their reports after the sweep; by default each report "
+                                 "looks its PTRs up and is written as soon as it is done")
+        parser.add_argument("--ptr-concurrency", type=int, default=256,
+                            help="PTR lookups in flight during a sweep")
+
+    def handle(self, *args, **options):
+        if options["source"] == "-":
+            domains = list(read_domains(sys.stdin))
+        else:
+            with open(options["source"], encoding="utf-8") as f:
+                domains = list(read_domains(f))
+        if options["rate"] > 0:
+            for upstream in get_pool().upstreams:
+                upstream.limiter = RateLimiter(options["rate"])
+        write = self.writer(options["format"])
+        batch = options["batch"]
+        size = max(1, batch or len(domains))
+        start = time.monotonic()
+        failed = 0
+        ptrs = 0
+        with ThreadPoolExecutor(max_workers=max(1, options["concurrency"])) as pool:
+            for first in range(0, len(domains), size):
+                chunk = domains[first:first + size]
+                futures = {pool.submit(audit, domain, bool(batch)): domain
+                           for domain in chunk}
+                reports = []
+                for future in as_completed(futures):
+                    try:
+                        report = future.result()
+                    except Exception as e:
+                        report = {"domain": futures[future], "error": repr(e)}
+                    if report.get("error"):
+                        failed += 1
+                    if batch:
+                        reports.append(report)
+                    else:
+                        write(report)
+                if reports:
+                    ptrs += sweep_batch(reports, options["ptr_concurrency"])["dns_queries"]
+                for report in reports:
+                    write(report)
+        elapsed = time.monotonic() - start
+        self.stderr.write("%d domains (%d failed) in %.1fs, %.1f domains/min" % (
+            len(domains), failed, elapsed, len(domains) / elapsed * 60 if elapsed else 0))
+        if batch:
+            self.stderr.write("%d PTR lookups sent in batches of %d domains" % (ptrs, batch))
+
+    def writer(self, fmt):
+        if fmt == "csv":
+            out = csv.DictWriter(self.stdout, COLUMNS, extrasaction="ignore", lineterminator="\n")
+            out.writeheader()
+
+            def write(report):
+                row = dict(report)
+                if isinstance(row.get("ptr"), list):
+                    row["ptr"] = ["%s=%s" % (p["ip"], p["ptr"]) for p in row["ptr"]]
+                if isinstance(row.get("ns_auth"), list):
+                    row["ns_auth"] = ["%s=%s" % (n["ip"], n["status"]) for n in row["ns_auth"]]
+                out.writerow({k: " ".join(map(str, v)) if isinstance(v, list) else v
+                              for k, v in row.items()})
+                self.stdout.flush()
+            return write
+
+        def write(report):
+            self.stdout.write(json.dumps(report, ensure_ascii=False, default=str))
+            self.stdout.flush()
+        return write
@@ -0,0 +1,19 @@
+import sqlite3
+
+from django.core.management.base import BaseCommand
+
+from query import store
+
+
+class Command(BaseCommand):
+    help = "Import the old per-domain tables of query.db into the records table"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--database", default=store.DATABASE)
+
+    def handle(self, *args, **options):
+        conn = sqlite3.connect(options["database"])
+        imported = store.ensure_schema(conn)
+        conn.execute("VACUUM")
+        conn.close()
+        self.stdout.write("imported %d domains" % len(imported))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from query.prefetch import Prefetcher
+
+
+class Command(BaseCommand):
+    help = "Keep the caches of every domain in query.db warm, refreshing each before it expires"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=int,
+                            help="domains refreshed at the same time")
+        parser.add_argument("--dns-rate", type=float, help="DNS queries per second")
+        parser.add_argument("--whois-rate", type=float, help="WHOIS queries per second")
+        parser.add_argument("--asn-rate", type=float, help="IPASN lookups per second")
+        parser.add_argument("--once", action="store_true",
+                            help="refresh every known domain once and exit")
+
+    def handle(self, *args, **options):
+        prefetcher = Prefetcher(options["concurrency"], options["dns_rate"],
+                                options["whois_rate"], options["asn_rate"])
+        try:
+            prefetcher.run(once=options["once"])
+        except KeyboardInterrupt:
+            prefetcher.stop()
@@ -0,0 +1,20 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from query import asncache
+
+
+class Command(BaseCommand):
+    help = "Load a prefix -> ASN dump (\"prefix asn [country registry description]\" per line) into the ASN cache"
+
+    def add_arguments(self, parser):
+        parser.add_argument("source", help="dump file, or - for stdin")
+
+    def handle(self, *args, **options):
+        if options["source"] == "-":
+            count = asncache.preload(sys.stdin)
+        else:
+            with open(options["source"], encoding="utf-8") as f:
+                count = asncache.preload(f)
+        self.stdout.write("loaded %d prefixes" % count)
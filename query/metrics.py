@@ -0,0 +1,196 @@
+"""Timings of the report checks, exposed at /query/metrics.
+
+Every span() adds its duration to a per-check latency histogram and
+counts the exceptions that escape it by type.  While a view decorated
+with timed_view runs, the spans of its request are also summed up for
+its Server-Timing header.  The text format is the one Prometheus
+scrapes.
+"""
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+HIT_RATIOS = [
+    ("dns", "dns_cache_hits", "dns_queries"),
+    ("whois", "whois_cache_hits", "whois_queries"),
+    ("asn", "asn_cache_hits", "asn_lookups"),
+]
+
+_lock = threading.Lock()
+_histograms = {}
+_errors = Counter()
+_lookups = Counter()
+_current = contextvars.ContextVar("timings", default=None)
+
+
+class Timings:
+    def __init__(self):
+        self.durations = Counter()
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.durations[name] += seconds
+
+    def header(self, total=None):
+        with self._lock:
+            items = list(self.durations.items())
+        if total is not None:
+            items.append(("total", total))
+        return ", ".join("%s;dur=%.1f" % (name, seconds * 1000) for name, seconds in items)
+
+
+def observe(name, seconds):
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = [[0] * len(BUCKETS), 0, 0.0]
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram[0][i] += 1
+        histogram[1] += 1
+        histogram[2] += seconds
+    timings = _current.get()
+    if timings is not None:
+        timings.add(name, seconds)
+
+
+def error(name, exc):
+    with _lock:
+        _errors[name, type(exc).__name__] += 1
+
+
+def count_lookups(stats):
+    # the lookup counters of a finished report, see ReportContext.stats
+    with _lock:
+        _lookups.update(stats)
+
+
+@contextmanager
+def span(name):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        error(name, e)
+        raise
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+def timed(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def server_timing(response, timings, start):
+    # streamed responses have sent their headers before the spans ran
+    if not response.streaming:
+        response["Server-Timing"] = timings.header(time.perf_counter() - start)
+    return response
+
+
+def timed_view(view):
+    if asyncio.iscoroutinefunction(view):
+        @functools.wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            start = time.perf_counter()
+            timings = Timings()
+            token = _current.set(timings)
+            try:
+                response = await view(request, *args, **kwargs)
+            finally:
+                _current.reset(token)
+            return server_timing(response, timings, start)
+    else:
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            start = time.perf_counter()
+            timings = Timings()
+            token = _current.set(timings)
+            try:
+                response = view(request, *args, **kwargs)
+            finally:
+                _current.reset(token)
+            return server_timing(response, timings, start)
+    return wrapper
+
+
+def labels(**values):
+    return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                             for k, v in values.items())
+
+
+def render(cache_stats=None, upstreams=None, snapshots=None):
+    with _lock:
+        histograms = {name: (list(h[0]), h[1], h[2]) for name, h in _histograms.items()}
+        errors = dict(_errors)
+        lookups = dict(_lookups)
+    lines = ["# HELP dnsquery_check_seconds Time spent in each check",
+             "# TYPE dnsquery_check_seconds histogram"]
+    for name in sorted(histograms):
+        buckets, count, total = histograms[name]
+        for bound, value in zip(BUCKETS, buckets):
+            lines.append("dnsquery_check_seconds_bucket%s %d" % (labels(check=name, le=bound), value))
+        lines.append("dnsquery_check_seconds_bucket%s %d" % (labels(check=name, le="+Inf"), count))
+        lines.append("dnsquery_check_seconds_sum%s %f" % (labels(check=name), total))
+        lines.append("dnsquery_check_seconds_count%s %d" % (labels(check=name), count))
+    lines += ["# HELP dnsquery_check_errors_total Exceptions raised by each check",
+              "# TYPE dnsquery_check_errors_total counter"]
+    for (name, kind), value in sorted(errors.items()):
+        lines.append("dnsquery_check_errors_total%s %d" % (labels(check=name, error=kind), value))
+    lines += ["# HELP dnsquery_lookups_total Lookups of finished reports, by source",
+              "# TYPE dnsquery_lookups_total counter"]
+    for kind, value in sorted(lookups.items()):
+        lines.append("dnsquery_lookups_total%s %d" % (labels(kind=kind), value))
+    lines += ["# HELP dnsquery_cache_hit_ratio Share of report lookups answered from a cache",
+              "# TYPE dnsquery_cache_hit_ratio gauge"]
+    for cache, hits, misses in HIT_RATIOS:
+        total = lookups.get(hits, 0) + lookups.get(misses, 0)
+        ratio = lookups.get(hits, 0) / total if total else 0.0
+        lines.append("dnsquery_cache_hit_ratio%s %f" % (labels(cache=cache), ratio))
+    if cache_stats is not None:
+        lines += ["# HELP dnsquery_dnscache Counters of the DNS answer cache",
+                  "# TYPE dnsquery_dnscache gauge"]
+        for key, value in sorted(cache_stats.items()):
+            lines.append("dnsquery_dnscache%s %s" % (labels(stat=key), value))
+    if snapshots is not None:
+        lines += ["# HELP dnsquery_snapshots Counters and size of the report snapshot store",
+                  "# TYPE dnsquery_snapshots gauge"]
+        for key, value in sorted(snapshots.items()):
+            lines.append("dnsquery_snapshots%s %s" % (labels(stat=key), value))
+    if upstreams is not None:
+        # see upstreams.ResolverPool.stats
+        totals, servers = upstreams
+        lines += ["# HELP dnsquery_resolver_total Lookups of the resolver pool",
+                  "# TYPE dnsquery_resolver_total counter"]
+        for key, value in sorted(totals.items()):
+            lines.append("dnsquery_resolver_total%s %d" % (labels(event=key), value))
+        lines += ["# HELP dnsquery_upstream_total Queries sent to each upstream, by outcome",
+                  "# TYPE dnsquery_upstream_total counter"]
+        for name, _, _, _, counters in servers:
+            for key, value in sorted(counters.items()):
+                lines.append("dnsquery_upstream_total%s %d" % (labels(upstream=name, event=key),
+                                                               value))
+        lines += ["# HELP dnsquery_upstream_healthy Whether an upstream is tried first",
+                  "# TYPE dnsquery_upstream_healthy gauge"]
+        for name, healthy, _, _, _ in servers:
+            lines.append("dnsquery_upstream_healthy%s %d" % (labels(upstream=name), healthy))
+        lines += ["# HELP dnsquery_upstream_latency_seconds Recent answer latency of each upstream",
+                  "# TYPE dnsquery_upstream_latency_seconds gauge"]
+        for name, _, median, hedge, _ in servers:
+            for quantile, value in (("0.5", median), ("hedge", hedge)):
+                if value is not None:
+                    lines.append("dnsquery_upstream_latency_seconds%s %f" % (
+                        labels(upstream=name, quantile=quantile), value))
+    return "\n".join(lines) + "\n"
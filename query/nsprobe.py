@@ -0,0 +1,133 @@
+"""Direct checks of a domain's authoritative nameservers.
+
+Every address of every listed nameserver is asked for the zone's SOA
+and NS at once, over UDP without recursion, and whatever has not
+answered by DNSQUERY_NS_PROBE_TIMEOUT seconds counts as unreachable, so
+a dead nameserver costs the report one short deadline.  Each server
+gets a status:
+
+ok           authoritative answer with the newest serial and the
+             delegated NS set
+lame         answered, but not authoritatively for the zone
+out_of_sync  SOA serial older than the newest one seen
+ns_mismatch  its NS set differs from the delegation
+unreachable  no answer in time
+no_route     the query could not be sent (e.g. no IPv6 route here);
+             not held against the domain
+"""
+import selectors
+import socket
+import time
+
+import dns.exception
+import dns.flags
+import dns.message
+import dns.name
+import dns.rcode
+import dns.rdataclass
+import dns.rdatatype
+from django.conf import settings
+
+from .upstreams import make_query
+
+PROBE_TYPES = ("SOA", "NS")
+# worst first, see verdict
+PROBLEMS = ("lame", "out_of_sync", "ns_mismatch", "unreachable")
+
+
+def send(selector, result, zone, rdtype, port):
+    query = make_query(zone, rdtype)[2]
+    query.flags &= ~dns.flags.RD
+    family = socket.AF_INET6 if ":" in result["ip"] else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+    try:
+        sock.connect((result["ip"], port))
+        sock.send(query.to_wire())
+    except OSError:
+        sock.close()
+        raise
+    selector.register(sock, selectors.EVENT_READ, (result, rdtype, query, time.monotonic()))
+
+
+def record(result, rdtype, zone, response, seconds):
+    rrset = response.get_rrset(response.answer, zone, dns.rdataclass.IN,
+                               dns.rdatatype.from_text(rdtype))
+    if rdtype == "SOA":
+        result["rtt"] = round(seconds * 1000, 1)
+        result["authoritative"] = bool(response.flags & dns.flags.AA
+                                       and response.rcode() == dns.rcode.NOERROR
+                                       and rrset is not None)
+        if rrset is not None:
+            result["serial"] = rrset[0].serial
+    elif rrset is not None:
+        result["ns"] = sorted(str(data).rstrip(".").lower() for data in rrset)
+
+
+def classify(results, expected):
+    serials = [r["serial"] for r in results if r["authoritative"]]
+    newest = max(serials) if serials else None
+    for r in results:
+        if r["status"] == "no_route":
+            continue
+        if r["rtt"] is None:
+            r["status"] = "unreachable"
+        elif not r["authoritative"]:
+            r["status"] = "lame"
+        elif r["serial"] != newest:
+            r["status"] = "out_of_sync"
+        elif expected and r["ns"] is not None and set(r["ns"]) != expected:
+            r["status"] = "ns_mismatch"
+        else:
+            r["status"] = "ok"
+    return results
+
+
+def probe(domain, servers, expected=(), timeout=None, port=None):
+    # servers is [(nameserver host, ip)], expected the delegated NS names;
+    # returns a result dict per server, in order
+    if timeout is None:
+        timeout = getattr(settings, "DNSQUERY_NS_PROBE_TIMEOUT", 1.0)
+    if port is None:
+        port = getattr(settings, "DNSQUERY_NS_PROBE_PORT", 53)
+    zone = dns.name.from_text(domain)
+    results = [{"host": host, "ip": ip, "status": None, "rtt": None, "serial": None,
+                "authoritative": False, "ns": None} for host, ip in servers]
+    selector = selectors.DefaultSelector()
+    deadline = time.monotonic() + timeout
+    try:
+        for result in results:
+            try:
+                for rdtype in PROBE_TYPES:
+                    send(selector, result, zone, rdtype, port)
+            except OSError:
+                result["status"] = "no_route"
+        while selector.get_map() and time.monotonic() < deadline:
+            for key, _ in selector.select(deadline - time.monotonic()):
+                result, rdtype, query, sent = key.data
+                try:
+                    response = dns.message.from_wire(key.fileobj.recv(65535))
+                    if not query.is_response(response):
+                        continue
+                except (OSError, dns.exception.DNSException):
+                    # e.g. ICMP port unreachable
+                    response = None
+                selector.unregister(key.fileobj)
+                key.fileobj.close()
+                if response is not None:
+                    record(result, rdtype, zone, response, time.monotonic() - sent)
+    finally:
+        for key in list(selector.get_map().values()):
+            key.fileobj.close()
+        selector.close()
+    return classify(results, {name.rstrip(".").lower() for name in expected})
+
+
+def verdict(results):
+    # the worst status of the probed servers: "correct" when all are ok,
+    # "none" when there was nothing to probe
+    statuses = {r["status"] for r in results}
+    for problem in PROBLEMS:
+        if problem in statuses:
+            return problem
+    return "correct" if "ok" in statuses else "none"
@@ -0,0 +1,150 @@
+"""Persistent TCP and DNS-over-TLS connections to the upstreams.
+
+With DNSQUERY_DNS_TRANSPORT = "tcp" or "tls" the lookups of every
+request are written to a few long-lived connections per upstream, each
+without waiting for the answers to the queries before it (RFC 7766
+pipelining).  Answers come back in any order and are matched to their
+query by message id.  The connections live on one background event
+loop thread, are shared by all requests and are reopened when the
+upstream closes them.
+"""
+import asyncio
+import concurrent.futures
+import random
+import ssl
+import struct
+import threading
+
+CONNECT_TIMEOUT = 5
+
+_pipeline = None
+_pipeline_lock = threading.Lock()
+
+
+def resolve_future(future, result=None, exc=None):
+    # the caller may have given up on (cancelled) the future already
+    try:
+        if exc is not None:
+            future.set_exception(exc)
+        else:
+            future.set_result(result)
+    except concurrent.futures.InvalidStateError:
+        pass
+
+
+class Connection:
+    def __init__(self, upstream, ssl_context=None, tls_name=None):
+        self.upstream = upstream
+        self.ssl_context = ssl_context
+        self.tls_name = tls_name
+        self.closed = False
+        # {connection message id: (future, id of the caller's query)}
+        self.pending = {}
+        self._opening = None
+        self._writer = None
+
+    async def open(self):
+        reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.upstream.address, self.upstream.port,
+                                    ssl=self.ssl_context,
+                                    server_hostname=self.tls_name if self.ssl_context else None),
+            CONNECT_TIMEOUT)
+        asyncio.get_running_loop().create_task(self.read(reader))
+
+    def message_id(self):
+        while True:
+            qid = random.getrandbits(16)
+            if qid not in self.pending:
+                return qid
+
+    async def send(self, wire, future):
+        try:
+            if self._opening is None:
+                self._opening = asyncio.ensure_future(self.open())
+            await self._opening
+            if self.closed:
+                raise ConnectionResetError("connection to %s closed" % self.upstream)
+            qid = self.message_id()
+            self.pending[qid] = (future, wire[:2])
+            loop = asyncio.get_running_loop()
+            future.add_done_callback(
+                lambda f: loop.call_soon_threadsafe(self.pending.pop, qid, None))
+            self._writer.write(struct.pack("!HH", len(wire), qid) + wire[2:])
+            await self._writer.drain()
+        except Exception as e:
+            self.close(e)
+            resolve_future(future, exc=e)
+
+    async def read(self, reader):
+        error = ConnectionResetError("%s closed the connection" % self.upstream)
+        try:
+            while True:
+                length, = struct.unpack("!H", await reader.readexactly(2))
+                data = await reader.readexactly(length)
+                entry = self.pending.pop(struct.unpack("!H", data[:2])[0], None)
+                if entry is not None:
+                    future, original_id = entry
+                    resolve_future(future, original_id + data[2:])
+        except (asyncio.IncompleteReadError, OSError) as e:
+            if isinstance(e, OSError):
+                error = e
+        self.close(error)
+
+    def close(self, error):
+        self.closed = True
+        pending, self.pending = self.pending, {}
+        for future, _ in pending.values():
+            resolve_future(future, exc=error)
+        if self._writer is not None:
+            self._writer.close()
+
+
+class Pipeline:
+    def __init__(self, tls=False, connections=2, tls_name=None):
+        self.connections = max(1, connections)
+        self.tls_name = tls_name
+        self.ssl_context = None
+        if tls:
+            self.ssl_context = ssl.create_default_context()
+            if tls_name is None:
+                # opportunistic DNS-over-TLS: encrypted, not authenticated
+                self.ssl_context.check_hostname = False
+                self.ssl_context.verify_mode = ssl.CERT_NONE
+        self._open = {}
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name="dns-pipeline",
+                         daemon=True).start()
+
+    def connection(self, upstream):
+        # the least busy open connection to upstream; another one is
+        # opened while all are busy and there are fewer than the limit
+        key = (upstream.address, upstream.port)
+        conns = [c for c in self._open.get(key, []) if not c.closed]
+        idle = [c for c in conns if not c.pending]
+        if not idle and len(conns) < self.connections:
+            conns.append(Connection(upstream, self.ssl_context, self.tls_name))
+            idle = conns[-1:]
+        self._open[key] = conns
+        return idle[0] if idle else min(conns, key=lambda c: len(c.pending))
+
+    def submit(self, upstream, wire):
+        # a concurrent.futures.Future of the response wire to query wire
+        future = concurrent.futures.Future()
+
+        def send():
+            self.loop.create_task(self.connection(upstream).send(wire, future))
+
+        self.loop.call_soon_threadsafe(send)
+        return future
+
+    def stats(self):
+        return {"%s#%d" % key: len([c for c in conns if not c.closed])
+                for key, conns in list(self._open.items())}
+
+
+def get_pipeline(transport, connections=2, tls_name=None):
+    global _pipeline
+    with _pipeline_lock:
+        if _pipeline is None:
+            _pipeline = Pipeline(transport == "tls", connections, tls_name)
+        return _pipeline
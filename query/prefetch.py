@@ -0,0 +1,136 @@
+"""Background refresh of the domains query.db already knows.
+
+Every domain in the records table is refreshed a little before its
+cached data runs out: its DNS answers, its stored records, its ASN rows
+and its WHOIS record.  Each part is refreshed when it comes within
+DNSQUERY_PREFETCH_AHEAD (a fraction of its TTL, doubled at random to
+spread the work) of expiring.  A search for one of these domains then
+only reads caches.  Run it with ``manage.py prefetch_domains``, or in
+the web process with DNSQUERY_PREFETCH_THREAD = True.
+"""
+import heapq
+import logging
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+
+from django.conf import settings
+
+from . import checks, store, whoiscache
+from .refresh import refresh
+from .report import ReportContext
+from .resolve import QueryPlan, RateLimiter
+
+logger = logging.getLogger(__name__)
+
+RESCAN_EVERY = 600
+SPREAD = 30
+# seconds before a part whose refresh failed is tried again
+RETRY_AFTER = 300
+
+
+def limiter(rate):
+    return RateLimiter(rate) if rate and rate > 0 else None
+
+
+def expires(fetched_at, ttl):
+    # when a part fetched at fetched_at is due again; one that was never
+    # fetched, or is already due because its refresh just failed, waits
+    # RETRY_AFTER seconds instead of going straight back to the front
+    retry = time.time() + RETRY_AFTER
+    if fetched_at is None:
+        return retry
+    return max(datetime.fromisoformat(fetched_at).timestamp() + ttl, retry)
+
+
+class Prefetcher:
+    def __init__(self, concurrency=None, dns_rate=None, whois_rate=None, asn_rate=None,
+                 ahead=None):
+        def option(value, name, default):
+            return value if value is not None else getattr(settings, name, default)
+
+        self.concurrency = max(1, option(concurrency, "DNSQUERY_PREFETCH_CONCURRENCY", 4))
+        self.dns_limiter = limiter(option(dns_rate, "DNSQUERY_PREFETCH_DNS_RATE", 20))
+        self.whois_limiter = limiter(option(whois_rate, "DNSQUERY_PREFETCH_WHOIS_RATE", 0.5))
+        self.asn_limiter = limiter(option(asn_rate, "DNSQUERY_PREFETCH_ASN_RATE", 1))
+        self.ahead = option(ahead, "DNSQUERY_PREFETCH_AHEAD", 0.1)
+        self.whois_ttl = getattr(settings, "DNSQUERY_WHOIS_TTL", 24 * 3600)
+        self.asn_ttl = getattr(settings, "DNSQUERY_ASN_TTL", 7 * 24 * 3600)
+        self._stop = threading.Event()
+
+    def early(self, ttl):
+        # how long before expiry a part with this TTL is refreshed
+        return ttl * self.ahead * (1 + random.random())
+
+    def prefetch(self, domain):
+        # refreshes every part of domain that is close to expiring and
+        # returns when the next one is, or None for a domain that is gone
+        whois_ttl = self.whois_ttl - self.early(self.whois_ttl)
+        asn_ttl = self.asn_ttl - self.early(self.asn_ttl)
+        ctx = ReportContext(domain, QueryPlan(limiter=self.dns_limiter, refresh_cache=True),
+                            whois_limiter=self.whois_limiter, asn_limiter=self.asn_limiter)
+        checks.plan_report(ctx)
+        if not checks.domain_exists(ctx):
+            logger.info("prefetch %s: NXDOMAIN, dropped", domain)
+            return None
+        conn = store.connect()
+        refresh(ctx, conn, asn_ttl)
+        record = whoiscache.lookup(domain, ctx.stats, whois_ttl, self.whois_limiter)
+        logger.debug("prefetch %s: %s", domain, dict(ctx.stats))
+        dns_ttl = ctx.plan.min_ttl() or 300
+        state = store.load_state(conn, domain)
+        return min(time.time() + dns_ttl - self.early(dns_ttl),
+                   expires(state.get("asn", (None,))[0], asn_ttl),
+                   expires(record.fetched_at, whois_ttl))
+
+    def run(self, once=False):
+        # once=True refreshes every known domain one time and returns
+        queue = []
+        scheduled = set()
+        next_scan = 0
+        in_flight = {}
+        with ThreadPoolExecutor(max_workers=self.concurrency,
+                                thread_name_prefix="prefetch") as pool:
+            while not self._stop.is_set():
+                now = time.time()
+                if now >= next_scan:
+                    # new domains start at a random point of the next
+                    # SPREAD seconds instead of all at once
+                    spread = 0 if once else SPREAD
+                    for domain in store.known_domains(store.connect()):
+                        if domain not in scheduled:
+                            scheduled.add(domain)
+                            heapq.heappush(queue, (now + random.uniform(0, spread), domain))
+                    next_scan = float("inf") if once else now + RESCAN_EVERY
+                while queue and queue[0][0] <= now and len(in_flight) < self.concurrency:
+                    _, domain = heapq.heappop(queue)
+                    in_flight[pool.submit(self.prefetch, domain)] = domain
+                if once and not queue and not in_flight:
+                    return
+                timeout = max(0.0, queue[0][0] - now) if queue else 1.0
+                done, _ = wait(list(in_flight), timeout=min(timeout, 1.0),
+                               return_when=FIRST_COMPLETED)
+                if not in_flight:
+                    self._stop.wait(min(timeout, 1.0))
+                for future in done:
+                    domain = in_flight.pop(future)
+                    try:
+                        due = future.result()
+                    except Exception as e:
+                        logger.warning("prefetch %s failed: %r", domain, e)
+                        due = time.time() + RETRY_AFTER
+                    # a dropped domain stays in scheduled so rescans skip it
+                    if due is not None and not once:
+                        heapq.heappush(queue, (due, domain))
+
+    def stop(self):
+        self._stop.set()
+
+
+def start():
+    # a daemon thread running the scheduler with the settings' limits
+    prefetcher = Prefetcher()
+    threading.Thread(target=prefetcher.run, name="prefetch", daemon=True).start()
+    return prefetcher
@@ -0,0 +1,104 @@
+"""Incremental refresh of the stored records of a domain.
+
+The rows of the records table go stale for different reasons:
+
+* the zone records (A, AAAA, NS, MX, TXT, SOA) when the SOA serial moves;
+* the ASN rows when the nameserver IPs change or DNSQUERY_ASN_TTL passes.
+
+WHOIS has its own table and TTL (see whoiscache).  refresh() works out
+which of these are stale and re-fetches and rewrites only those, so a
+changed TXT record costs neither a WHOIS query nor any IPASN lookups.
+"""
+from datetime import datetime, timedelta, timezone
+
+from django.conf import settings
+
+from . import checks, store, whoiscache
+from .report import ASN_FIELDS
+
+ZONE_TYPES = checks.RECORD_TYPES
+
+
+def live_serial(ctx):
+    try:
+        for data in ctx.resolve(ctx.domain, "SOA"):
+            return data.serial
+    except Exception:
+        return None
+
+
+def zone_stale(state, serial):
+    if serial is None:
+        return True
+    return any(state.get(t, (None, None))[1] != serial for t in ZONE_TYPES)
+
+
+def asn_stale(ctx, state, stored_ips, ttl=None):
+    if ttl is None:
+        ttl = getattr(settings, "DNSQUERY_ASN_TTL", 7 * 24 * 3600)
+    if any(t not in state for t in ASN_FIELDS):
+        return True
+    fetched_at = state["asn"][0]
+    if fetched_at is None:
+        return True
+    age = datetime.now(timezone.utc) - datetime.fromisoformat(fetched_at)
+    if age >= timedelta(seconds=ttl):
+        return True
+    if stored_ips == ["private_error"]:
+        # a private-use nameserver IP has no ASN to go stale
+        return False
+    try:
+        return ctx.ns_ips() != stored_ips
+    except Exception:
+        return True
+
+
+def stale(ctx, conn=None, asn_ttl=None, snapshot=None):
+    # the stale components of the stored records, a subset of {"zone", "asn"};
+    # read from a snapshot.DomainReport of them instead of query.db if given
+    if snapshot is not None:
+        state, stored_ips = snapshot.state, snapshot.get("ip", [])
+    else:
+        conn = conn or store.connect()
+        state = store.load_state(conn, ctx.domain)
+        stored_ips = store.load_records(conn, ctx.domain, "ip")
+    components = set()
+    if zone_stale(state, live_serial(ctx)):
+        components.add("zone")
+    if asn_stale(ctx, state, stored_ips, asn_ttl):
+        components.add("asn")
+    return components
+
+
+def refresh(ctx, conn=None, asn_ttl=None):
+    # returns the record types that were rewritten
+    conn = conn or store.connect()
+    components = stale(ctx, conn, asn_ttl)
+    rows = []
+    types = set()
+    if "zone" in components:
+        # the types zone_records left out went unanswered and keep their rows
+        zone_rows = checks.zone_records(ctx)
+        rows += zone_rows
+        types.update(t for t, _ in zone_rows)
+    if "asn" in components and ctx.as_records() != "lookup_error":
+        # a failed ASN lookup keeps the old rows until the next refresh
+        rows += checks.asn_records(ctx)
+        types.update(ASN_FIELDS)
+    if not types:
+        return []
+    return store.replace_records(conn, ctx.domain, rows, live_serial(ctx), types)
+
+
+def version(ctx, conn=None, snapshot=None):
+    # (SOA serial, latest fetched_at of the stored records and WHOIS) of
+    # what a report on ctx.domain would show now
+    if snapshot is not None:
+        state, record = snapshot.state, snapshot.whois
+    else:
+        conn = conn or store.connect()
+        state, record = store.load_state(conn, ctx.domain), whoiscache.cached(ctx.domain)
+    stamps = [fetched_at for fetched_at, _ in state.values()]
+    if record is not None and record.fetched_at:
+        stamps.append(record.fetched_at)
+    return live_serial(ctx), max(stamps, default=None)
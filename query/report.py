@@ -0,0 +1,169 @@
+"""Request-scoped lookup results shared by every check of one report.
+
+Each (qname, rdtype) and each IP->ASN lookup happens at most once per
+report; ``stats`` counts what was actually sent upstream.
+"""
+import asyncio
+import contextvars
+import functools
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from . import asncache, metrics, nsprobe, snapshot, whoiscache
+from .resolve import QueryPlan
+
+ASN_FIELDS = ["ip", "asn", "country", "registry", "description"]
+RECENT_REPORTS = 64
+# the longest a finished report's answers are reused by its details pages
+RECENT_MAX_AGE = 60
+
+logger = logging.getLogger(__name__)
+
+_recent = OrderedDict()
+_recent_lock = threading.Lock()
+_blocking = None
+
+
+class ReportContext:
+    def __init__(self, domain, plan=None, whois_limiter=None, asn_limiter=None):
+        self.domain = domain
+        self.plan = plan or QueryPlan()
+        self.whois_limiter = whois_limiter
+        self.asn_limiter = asn_limiter
+        self.stats = self.plan.stats
+        self._asn = {}
+        self._as_records = None
+        self._ns_probe = None
+        self._whois = None
+        # the registrar and whois_ns sections of a streamed report ask
+        # at once and must share one lookup
+        self._whois_lock = threading.Lock()
+
+    def resolve(self, name, rdtype):
+        return self.plan.get(name, rdtype)
+
+    @metrics.timed("whois")
+    def whois(self):
+        with self._whois_lock:
+            if self._whois is None:
+                snapshots = snapshot.get_store()
+                self._whois = snapshots.whois(self.domain)
+                if self._whois is not None:
+                    self.stats.add("whois_cache_hits")
+                else:
+                    self._whois = whoiscache.lookup(self.domain, self.stats,
+                                                    limiter=self.whois_limiter)
+                    snapshots.set_whois(self.domain, self._whois)
+            return self._whois
+
+    def asn_lookup(self, ip):
+        if ip not in self._asn:
+            self._asn[ip] = asncache.lookup(ip, self.stats, self.asn_limiter)
+        return self._asn[ip]
+
+    def ns_ips(self):
+        # a nameserver host without an A record (e.g. a dangling NS) adds
+        # no addresses, as in ns_probe
+        ip_list = set()
+        for ns_data in self.resolve(self.domain, "NS"):
+            try:
+                ip_list.update(str(a_data) for a_data in self.resolve(str(ns_data), "A"))
+            except Exception:
+                pass
+        return sorted(ip_list)
+
+    @metrics.timed("as_search")
+    def as_records(self):
+        # {"ip": [...], "asn": [...], ...} for the nameserver IPs,
+        # "private_error" when one of them is private-use, or
+        # "lookup_error" when the lookups failed
+        if self._as_records is None:
+            from ipwhois.exceptions import IPDefinedError
+            records = {x: [] for x in ASN_FIELDS}
+            try:
+                records["ip"] = self.ns_ips()
+                for ip in records["ip"]:
+                    results = self.asn_lookup(ip)
+                    records["asn"].append(results['asn'])
+                    records["country"].append(results['asn_country_code'])
+                    records["registry"].append(results['asn_registry'])
+                    records["description"].append(results['asn_description'])
+            except IPDefinedError:
+                logger.warning("%s: nameserver IP is private-use", self.domain)
+                records = "private_error"
+            except Exception as e:
+                logger.warning("%s: ASN lookup failed: %r", self.domain, e)
+                records = "lookup_error"
+            self._as_records = records
+        return self._as_records
+
+
+    @metrics.timed("ns_probe")
+    def ns_probe(self):
+        # every address of every nameserver asked for the zone's SOA and
+        # NS directly, see nsprobe
+        if self._ns_probe is None:
+            try:
+                ns = [str(data) for data in self.resolve(self.domain, "NS")]
+            except Exception:
+                ns = []
+            servers = []
+            for host in ns:
+                for rdtype in ("A", "AAAA"):
+                    try:
+                        servers += [(host.rstrip("."), str(data))
+                                    for data in self.resolve(host, rdtype)]
+                    except Exception:
+                        pass
+            self._ns_probe = nsprobe.probe(self.domain, servers, ns)
+        return self._ns_probe
+
+
+def remember(ctx):
+    # the answers of a finished report, kept for the shortest TTL among
+    # them and at most RECENT_MAX_AGE seconds
+    ttl = ctx.plan.min_ttl()
+    age = RECENT_MAX_AGE if ttl is None else min(ttl, RECENT_MAX_AGE)
+    with _recent_lock:
+        _recent[ctx.domain] = (time.monotonic() + age, ctx.plan.answers())
+        _recent.move_to_end(ctx.domain)
+        while len(_recent) > RECENT_REPORTS:
+            _recent.popitem(last=False)
+
+
+def recent_context(domain):
+    # a context of its own for a details page, seeded with the answers of
+    # the report it links from while they are fresh
+    ctx = ReportContext(domain)
+    with _recent_lock:
+        entry = _recent.get(domain)
+        if entry is not None and entry[0] <= time.monotonic():
+            del _recent[domain]
+            entry = None
+    if entry is not None:
+        ctx.plan.seed(entry[1])
+    return ctx
+
+
+def blocking_pool():
+    # WHOIS, IPASN and SQLite calls run here, off the request thread or
+    # event loop, on a pool sized for slow network calls
+    global _blocking
+    with _recent_lock:
+        if _blocking is None:
+            _blocking = ThreadPoolExecutor(
+                max_workers=getattr(settings, "DNSQUERY_BLOCKING_WORKERS", 64),
+                thread_name_prefix="report")
+    return _blocking
+
+
+async def run_blocking(func, *args):
+    # in a copy of the caller's context, so the spans reach its timings
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        blocking_pool(), functools.partial(context.run, func, *args))
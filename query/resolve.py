@@ -0,0 +1,198 @@
+"""Concurrent DNS resolution for the report views.
+
+A report needs a few dozen (name, rdtype) answers.  QueryPlan collects
+them, drops duplicates and resolves the whole batch on a bounded thread
+pool (resolve) or on the running event loop (resolve_async), so a report
+costs the slowest lookup instead of the sum of all.  The lookups go to
+the upstreams of upstreams.get_pool(), unless a zone snapshot of
+xfr.get_zones() answers them.
+"""
+import asyncio
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from . import metrics
+from .dnscache import NEGATIVE_ERRORS, Negative, get_cache, negative
+from .upstreams import get_pool
+
+
+class RateLimiter:
+    # token bucket: at most `rate` acquisitions per second, `burst` at once
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        # takes a token and returns how long the caller must wait for it
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            return max(0.0, -self._tokens / self.rate)
+
+    def acquire(self):
+        time.sleep(self.reserve())
+
+    async def acquire_async(self):
+        await asyncio.sleep(self.reserve())
+
+
+class Stats(Counter):
+    # the lookup counters of one report; the sections of a streamed
+    # report count into it from several threads at once
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+
+    def add(self, key, n=1):
+        with self._lock:
+            self[key] += n
+
+
+def query_key(name, rdtype):
+    return str(name).rstrip(".").lower(), str(rdtype).upper()
+
+
+class QueryPlan:
+    def __init__(self, resolver=None, max_workers=None, use_cache=True, limiter=None,
+                 refresh_cache=False):
+        # refresh_cache sends every lookup upstream and stores the fresh
+        # answers, for warming the cache ahead of expiry
+        self.resolver = resolver
+        self.limiter = limiter
+        self.cache = get_cache() if use_cache else None
+        self.zones = None
+        if getattr(settings, "DNSQUERY_XFR_ZONES", None):
+            # dns.zone and the transfers load only for configured zones
+            from .xfr import get_zones
+            self.zones = get_zones()
+        self.refresh_cache = refresh_cache
+        if max_workers is None:
+            max_workers = getattr(settings, "DNSQUERY_RESOLVE_WORKERS", 16)
+        self.max_workers = max_workers
+        self.negative_ttl = getattr(settings, "DNSQUERY_CACHE_NEGATIVE_TTL", 300)
+        self.stats = Stats()
+        self._pending = []
+        self._results = {}
+
+    def add(self, name, rdtype):
+        key = query_key(name, rdtype)
+        if key not in self._results and key not in self._pending:
+            self._pending.append(key)
+
+    def resolve(self):
+        pending, self._pending = self._pending, []
+        pending = [key for key in pending if not self._cached(key)]
+        if not pending:
+            return
+        self.stats.add("dns_queries", len(pending))
+        workers = max(1, min(self.max_workers, len(pending)))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for key, result in zip(pending, pool.map(self._lookup, pending)):
+                self._results[key] = result
+
+    async def resolve_async(self):
+        pending, self._pending = self._pending, []
+        # the first transfer of a zone must not block the event loop
+        pending = [key for key in pending if not self._cached(key, wait=False)]
+        if not pending:
+            return
+        self.stats.add("dns_queries", len(pending))
+        slots = asyncio.Semaphore(max(1, self.max_workers))
+        results = await asyncio.gather(*(self._lookup_async(key, slots) for key in pending))
+        for key, result in zip(pending, results):
+            self._results[key] = result
+
+    def get(self, name, rdtype):
+        # returns the RRset or raises the exception the lookup raised;
+        # names that were never planned are resolved on the spot
+        key = query_key(name, rdtype)
+        if key in self._results:
+            self.stats.add("dns_memo_hits")
+        elif not self._cached(key):
+            self.stats.add("dns_queries")
+            self._results[key] = self._lookup(key)
+        result = self._results[key]
+        if isinstance(result, Negative):
+            raise result.error(key[0])
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def answers(self):
+        # the answers looked up so far, for seeding another plan; the
+        # lookups that failed are left for it to retry
+        return {key: result for key, result in self._results.items()
+                if not isinstance(result, Exception)}
+
+    def seed(self, answers):
+        for key, result in answers.items():
+            self._results.setdefault(key, result)
+
+    def min_ttl(self):
+        # the shortest remaining TTL of the answers looked up so far
+        ttls = []
+        for key, result in self._results.items():
+            if isinstance(result, (Negative, Exception)):
+                continue
+            ttl = result.ttl
+            if self.cache is not None:
+                remaining = self.cache.ttl(key)
+                if remaining is not None:
+                    ttl = min(ttl, remaining)
+            ttls.append(ttl)
+        return min(ttls) if ttls else None
+
+    def _cached(self, key, wait=True):
+        if self.zones is not None:
+            hit, result = self.zones.lookup(key, wait)
+            if hit:
+                self.stats.add("zone_hits")
+                self._results[key] = result
+                return True
+        if self.cache is None or self.refresh_cache:
+            return False
+        hit, result = self.cache.get(key)
+        if hit:
+            self.stats.add("dns_cache_hits")
+            self._results[key] = result
+        return hit
+
+    def _lookup(self, key):
+        resolver = self.resolver or get_pool()
+        if self.limiter is not None:
+            self.limiter.acquire()
+        try:
+            with metrics.span("dns_query"):
+                result = resolver.resolve(key[0], key[1]).rrset
+        except NEGATIVE_ERRORS as e:
+            result = negative(e, self.negative_ttl)
+        except Exception as e:
+            result = e
+        if self.cache is not None:
+            self.cache.put(key, result)
+        return result
+
+    async def _lookup_async(self, key, slots):
+        async with slots:
+            if self.limiter is not None:
+                await self.limiter.acquire_async()
+            try:
+                with metrics.span("dns_query"):
+                    answer = await get_pool().resolve_async(key[0], key[1])
+                result = answer.rrset
+            except NEGATIVE_ERRORS as e:
+                result = negative(e, self.negative_ttl)
+            except Exception as e:
+                result = e
+        if self.cache is not None:
+            self.cache.put(key, result)
+        return result
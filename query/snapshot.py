@@ -0,0 +1,146 @@
+"""In-memory snapshots of the stored records of recently viewed domains.
+
+Once a report has refreshed a domain's rows in query.db, they are read
+into a DomainReport, together with the freshness state that refresh
+checks.  Snapshots live in a bounded LRU keyed by domain and SOA serial
+(DNSQUERY_SNAPSHOT_ENTRIES).  The domain's WHOIS record joins the
+snapshot once the report has looked it up.  A repeat view whose serial
+has not moved, and whose ASN rows and WHOIS are still fresh, then
+renders without reading SQLite.
+"""
+import sys
+import threading
+from collections import Counter, OrderedDict
+
+from django.conf import settings
+
+from . import store, whoiscache
+
+# stored record type -> DomainReport slot
+FIELDS = {
+    "A": "a", "AAAA": "aaaa", "NS": "ns", "MX": "mx", "TXT": "txt", "SOA": "soa",
+    "ip": "ip", "asn": "asn", "country": "country", "registry": "registry",
+    "description": "description",
+}
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def intern_all(values):
+    return tuple(sys.intern(v) if isinstance(v, str) else v for v in values)
+
+
+class DomainReport:
+    __slots__ = ("domain", "serial", "state", "whois") + tuple(FIELDS.values())
+
+    def __init__(self, domain, serial, stored, state, whois=None):
+        # stored and state as store.load_domain and store.load_state return them
+        self.domain = sys.intern(store.domain_key(domain))
+        self.serial = serial
+        self.state = {sys.intern(t): intern_all(s) for t, s in state.items()}
+        self.whois = whois
+        for record_type, slot in FIELDS.items():
+            values = stored.get(record_type)
+            setattr(self, slot, None if values is None else intern_all(values))
+
+    def get(self, record_type, default=None):
+        # the stored values of record_type, like the dict of load_domain
+        slot = FIELDS.get(record_type)
+        values = getattr(self, slot) if slot else None
+        return default if values is None else list(values)
+
+
+def footprint(obj, seen=None):
+    # bytes held by obj and everything it refers to; interned strings
+    # shared with other snapshots are counted for each of them
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(footprint(k, seen) + footprint(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (tuple, list, set)):
+        size += sum(footprint(v, seen) for v in obj)
+    elif hasattr(obj, "__slots__"):
+        size += sum(footprint(getattr(obj, slot, None), seen) for slot in obj.__slots__)
+    elif hasattr(obj, "__dict__"):
+        size += footprint(vars(obj), seen)
+    return size
+
+
+class SnapshotStore:
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self.counters = Counter()
+        self.size = 0
+        # {domain: (DomainReport, bytes)}, one serial per domain
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, domain, serial):
+        domain = store.domain_key(domain)
+        with self._lock:
+            entry = self._entries.get(domain)
+            if entry is None or serial is None or entry[0].serial != serial:
+                self.counters["misses"] += 1
+                return None
+            self._entries.move_to_end(domain)
+            self.counters["hits"] += 1
+            return entry[0]
+
+    def put(self, report):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            old = self._entries.pop(report.domain, None)
+            if old is not None:
+                self.size -= old[1]
+                if report.whois is None:
+                    report.whois = old[0].whois
+            size = footprint(report)
+            self._entries[report.domain] = (report, size)
+            self.size += size
+            while len(self._entries) > self.max_entries:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.size -= evicted
+                self.counters["evictions"] += 1
+
+    def whois(self, domain):
+        # the fresh WHOIS record of domain's snapshot, or None
+        with self._lock:
+            entry = self._entries.get(store.domain_key(domain))
+        record = entry[0].whois if entry is not None else None
+        if record is not None and whoiscache.fresh(record):
+            return record
+        return None
+
+    def set_whois(self, domain, record):
+        if record.fetched_at is None:
+            return
+        domain = store.domain_key(domain)
+        with self._lock:
+            entry = self._entries.get(domain)
+            if entry is not None:
+                report, size = entry
+                report.whois = record
+                new_size = footprint(report)
+                self._entries[domain] = (report, new_size)
+                self.size += new_size - size
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            entries = len(self._entries)
+            stats.update(entries=entries, bytes=self.size, max_entries=self.max_entries,
+                         bytes_per_domain=self.size // entries if entries else 0)
+        return stats
+
+
+def get_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = SnapshotStore(getattr(settings, "DNSQUERY_SNAPSHOT_ENTRIES", 1000))
+        return _store
@@ -0,0 +1,335 @@
+"""Record storage in query.db.
+
+Every domain lives in one ``records`` table indexed by
+(domain, record_type).  Older databases kept one table per
+domain; those are imported and dropped the first time query.db is
+opened by a process (or explicitly with ``manage.py import_legacy_tables``).
+
+Each thread keeps one open connection per database file.  Connections
+run in WAL mode so readers never block the writer, wait up to
+BUSY_TIMEOUT ms for a lock, and take the write lock up front
+(BEGIN IMMEDIATE) so two writers queue instead of failing with
+"database is locked".
+
+record_history is an append-only log of the zone records: a row is
+written only when a (record_type, record_value) pair appears ("+") or
+disappears ("-"), with the SOA serial and time of the refresh that saw
+it.  The ASN rows are derived data and are not logged.
+"""
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from . import metrics
+
+DATABASE = "query.db"
+BUSY_TIMEOUT = 10000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    domain text NOT NULL,
+    record_type text NOT NULL,
+    record_value text,
+    fetched_at text,
+    soa_serial integer
+);
+CREATE INDEX IF NOT EXISTS records_domain_type
+    ON records (domain, record_type);
+CREATE TABLE IF NOT EXISTS record_history (
+    domain text NOT NULL,
+    record_type text NOT NULL,
+    record_value text,
+    change text NOT NULL,
+    soa_serial integer,
+    changed_at text NOT NULL
+);
+CREATE INDEX IF NOT EXISTS record_history_domain_time
+    ON record_history (domain, changed_at);
+CREATE TABLE IF NOT EXISTS whois (
+    domain text PRIMARY KEY,
+    registrar text,
+    expiration_date text,
+    name_servers text,
+    fetched_at text
+);
+CREATE TABLE IF NOT EXISTS asn_prefixes (
+    prefix text PRIMARY KEY,
+    asn text,
+    country text,
+    registry text,
+    description text,
+    fetched_at text
+);
+"""
+
+# the zone records a report stores, see checks.RECORD_TYPES
+ZONE_TYPES = ("A", "AAAA", "NS", "MX", "TXT", "SOA")
+# the ASN lists are aligned per nameserver IP, so their order matters
+ORDERED_TYPES = {"ip", "asn", "country", "registry", "description"}
+
+_ready = set()
+_ready_lock = threading.Lock()
+_local = threading.local()
+
+
+def domain_key(domain):
+    return str(domain).rstrip(".").lower()
+
+
+def legacy_table_name(domain):
+    # the per-domain table name the old views derived from a domain
+    name = re.sub(r"[.\-]", "_", domain_key(domain))
+    if re.search(r"^\d", name):
+        name = "_"+name
+    return name
+
+
+def connect(database=DATABASE):
+    # the calling thread's connection to database, opened on first use
+    pool = getattr(_local, "pool", None)
+    if pool is None:
+        pool = _local.pool = {}
+    conn = pool.get(database)
+    if conn is None:
+        conn = sqlite3.connect(database, timeout=BUSY_TIMEOUT / 1000,
+                               isolation_level=None, cached_statements=256)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=%d" % BUSY_TIMEOUT)
+        with _ready_lock:
+            if database not in _ready:
+                ensure_schema(conn)
+                _ready.add(database)
+        pool[database] = conn
+    return conn
+
+
+def close(database=DATABASE):
+    conn = getattr(_local, "pool", {}).pop(database, None)
+    if conn is not None:
+        conn.close()
+
+
+@contextmanager
+def transaction(conn):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def ensure_schema(conn):
+    conn.executescript(SCHEMA)
+    imported = import_legacy_tables(conn)
+    drop_legacy_whois(conn)
+    start_history(conn)
+    return imported
+
+
+def start_history(conn):
+    # a database without history yet starts it from the stored records
+    with transaction(conn):
+        if conn.execute("SELECT 1 FROM record_history LIMIT 1").fetchone() is None:
+            conn.execute("INSERT INTO record_history SELECT domain, record_type, record_value, "
+                         "'+', soa_serial, fetched_at FROM records WHERE record_type IN "
+                         "(%s) ORDER BY rowid" % ", ".join("'%s'" % t for t in ZONE_TYPES))
+
+
+def drop_legacy_whois(conn):
+    # the raw WHOIS blobs the per-domain tables kept; WHOIS lives in the
+    # whois table now, see whoiscache
+    with transaction(conn):
+        conn.execute("DELETE FROM records WHERE record_type='whois'")
+        conn.execute("DELETE FROM record_history WHERE record_type='whois'")
+
+
+def legacy_tables(conn):
+    rows = conn.execute("SELECT name FROM sqlite_master WHERE type='table' "
+                        "AND name NOT LIKE 'sqlite_%' AND name != 'records'")
+    tables = []
+    for (name,) in rows:
+        columns = [row[1] for row in conn.execute('PRAGMA table_info("%s")' % name)]
+        if columns == ["record_type", "record_value"]:
+            tables.append(name)
+    return tables
+
+
+def legacy_domain(table, rows):
+    # prefer the domain_name of the stored whois blob, as long as it maps
+    # back to the same table name; fall back to un-mangling the name
+    for record_type, value in rows:
+        if record_type == "whois":
+            match = re.search(r'"domain_name": \[?\s*"([^"]+)"', value)
+            if match and legacy_table_name(match.group(1)) == table:
+                return domain_key(match.group(1))
+    return re.sub(r"^_(?=\d)", "", table).replace("_", ".")
+
+
+def soa_serial(soa_text):
+    fields = str(soa_text).split()
+    try:
+        return int(fields[2])
+    except (IndexError, ValueError):
+        return None
+
+
+def import_legacy_tables(conn):
+    imported = []
+    fetched_at = now()
+    with transaction(conn):
+        for table in legacy_tables(conn):
+            rows = conn.execute('SELECT record_type, record_value FROM "%s"' % table).fetchall()
+            domain = legacy_domain(table, rows)
+            serial = None
+            for record_type, value in rows:
+                if record_type == "SOA":
+                    serial = soa_serial(value)
+            conn.executemany("INSERT INTO records VALUES (?, ?, ?, ?, ?)",
+                             [(domain, t, v, fetched_at, serial) for t, v in rows
+                              if t != "whois"])
+            conn.execute('DROP TABLE "%s"' % table)
+            imported.append(domain)
+    return imported
+
+
+def now():
+    return datetime.now(timezone.utc).isoformat(timespec="seconds")
+
+
+def group(rows):
+    grouped = {}
+    for record_type, value in rows:
+        if value is not None:
+            value = str(value)
+        grouped.setdefault(str(record_type), []).append(value)
+    return grouped
+
+
+def history_rows(domain, record_type, old, new, serial, changed_at):
+    old, new = set(old or []), set(new or [])
+    rows = [(domain, record_type, v, "-", serial, changed_at) for v in sorted(old - new, key=str)]
+    rows += [(domain, record_type, v, "+", serial, changed_at) for v in sorted(new - old, key=str)]
+    return rows
+
+
+def unchanged(record_type, old, new):
+    if old is None or new is None:
+        return old is new
+    if record_type in ORDERED_TYPES:
+        return old == new
+    return sorted(old, key=str) == sorted(new, key=str)
+
+
+@metrics.timed("sqlite.replace_records")
+def replace_records(conn, domain, rows, serial=None, types=None):
+    # rows is the complete new set of (record_type, record_value) pairs of
+    # the given record types (of every type when types is None); only the
+    # types whose values changed are rewritten, the others just get the
+    # new fetched_at and serial; the pairs that appeared or disappeared
+    # are appended to record_history
+    domain = domain_key(domain)
+    new = group(rows)
+    with transaction(conn):
+        old = group(conn.execute("SELECT record_type, record_value FROM records "
+                                 "WHERE domain=? ORDER BY rowid", (domain,)))
+        if types is None:
+            types = set(old) | set(new)
+        changed = [t for t in sorted(types) if not unchanged(t, old.get(t), new.get(t))]
+        fetched_at = now()
+        conn.executemany("UPDATE records SET fetched_at=?, soa_serial=? "
+                         "WHERE domain=? AND record_type=?",
+                         [(fetched_at, serial, domain, t) for t in types if t not in changed])
+        conn.executemany("DELETE FROM records WHERE domain=? AND record_type=?",
+                         [(domain, t) for t in changed])
+        conn.executemany("INSERT INTO records VALUES (?, ?, ?, ?, ?)",
+                         [(domain, t, v, fetched_at, serial)
+                          for t in changed for v in new.get(t, [])])
+        conn.executemany("INSERT INTO record_history VALUES (?, ?, ?, ?, ?, ?)",
+                         [row for t in changed if t in ZONE_TYPES
+                          for row in history_rows(domain, t, old.get(t), new.get(t),
+                                                  serial, fetched_at)])
+    return changed
+
+
+@metrics.timed("sqlite.load_history")
+def load_history(conn, domain, since=None):
+    # (changed_at, soa_serial, change, record_type, record_value) of
+    # domain, oldest first, from `since` (an ISO timestamp) on
+    return conn.execute("SELECT changed_at, soa_serial, change, record_type, record_value "
+                        "FROM record_history WHERE domain=? AND changed_at >= ? "
+                        "ORDER BY changed_at, rowid",
+                        (domain_key(domain), since or "")).fetchall()
+
+
+@metrics.timed("sqlite.records_as_of")
+def records_as_of(conn, domain, when):
+    # the zone records of domain as they were at `when` (an ISO
+    # timestamp), {record_type: [values]}: the pairs whose latest change
+    # by then was "+"
+    return group(conn.execute("SELECT record_type, record_value FROM ("
+                              "SELECT record_type, record_value, change, MAX(rowid) "
+                              "FROM record_history WHERE domain=? AND changed_at <= ? "
+                              "GROUP BY record_type, record_value) WHERE change='+' "
+                              "ORDER BY record_type, record_value",
+                              (domain_key(domain), when)))
+
+
+@metrics.timed("sqlite.load_records")
+def load_records(conn, domain, record_type):
+    rows = conn.execute("SELECT record_value FROM records WHERE domain=? AND record_type=? "
+                        "ORDER BY rowid", (domain_key(domain), record_type))
+    return [row[0] for row in rows]
+
+
+@metrics.timed("sqlite.load_state")
+def load_state(conn, domain):
+    # {record_type: (fetched_at, soa_serial)} of the stored records of domain
+    rows = conn.execute("SELECT record_type, MIN(fetched_at), MAX(soa_serial) FROM records "
+                        "WHERE domain=? GROUP BY record_type", (domain_key(domain),))
+    return {record_type: (fetched_at, serial) for record_type, fetched_at, serial in rows}
+
+
+@metrics.timed("sqlite.known_domains")
+def known_domains(conn):
+    return [row[0] for row in conn.execute("SELECT DISTINCT domain FROM records")]
+
+
+@metrics.timed("sqlite.load_domain")
+def load_domain(conn, domain):
+    # every stored record type of domain in one pass, {record_type: [values]}
+    return group(conn.execute("SELECT record_type, record_value FROM records "
+                              "WHERE domain=? ORDER BY rowid", (domain_key(domain),)))
+
+
+@metrics.timed("sqlite.save_whois")
+def save_whois(conn, record):
+    with transaction(conn):
+        conn.execute("INSERT OR REPLACE INTO whois VALUES (?, ?, ?, ?, ?)",
+                     (domain_key(record.domain), record.registrar, record.expiration_date,
+                      " ".join(record.name_servers), record.fetched_at))
+
+
+@metrics.timed("sqlite.load_whois")
+def load_whois(conn, domain):
+    # (registrar, expiration_date, name_servers, fetched_at) or None
+    return conn.execute("SELECT registrar, expiration_date, name_servers, fetched_at "
+                        "FROM whois WHERE domain=?", (domain_key(domain),)).fetchone()
+
+
+@metrics.timed("sqlite.save_prefixes")
+def save_prefixes(conn, rows):
+    # rows of (prefix, asn, country, registry, description, fetched_at)
+    with transaction(conn):
+        conn.executemany("INSERT OR REPLACE INTO asn_prefixes VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+
+@metrics.timed("sqlite.load_prefixes")
+def load_prefixes(conn, after=0):
+    # prefixes written after rowid `after`, as (rowid, prefix, asn, ...)
+    return conn.execute("SELECT rowid, prefix, asn, country, registry, description, fetched_at "
+                        "FROM asn_prefixes WHERE rowid > ? ORDER BY rowid", (after,)).fetchall()
@@ -1,3 +1,111 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+from unittest import mock
+
 from django.test import TestCase
 
-# Create your tests here.
+from . import store
+
+SOA = "ns1.example.com. hostmaster.example.com. 2022081501 7200 3600 1209600 300"
+ZONE = [("A", "192.0.2.10"), ("NS", "ns1.example.com."), ("NS", "ns2.example.com."),
+        ("MX", "0 mail.example.com."), ("TXT", '"v=spf1 -all"'), ("SOA", SOA)]
+ASN = [("ip", "198.51.100.1"), ("asn", "64500")]
+FIRST = "2022-08-01T00:00:00+00:00"
+SECOND = "2022-08-02T00:00:00+00:00"
+
+
+class StoreTestCase(TestCase):
+    # every test gets a query.db of its own in a temporary directory
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database = os.path.join(self.directory, "query.db")
+
+    def tearDown(self):
+        store.close(self.database)
+        shutil.rmtree(self.directory)
+
+    def connect(self):
+        return store.connect(self.database)
+
+
+class LegacyImportTests(StoreTestCase):
+    def create_legacy_table(self, table, rows):
+        conn = sqlite3.connect(self.database)
+        conn.execute('CREATE TABLE "%s" (record_type text, record_value text)' % table)
+        conn.executemany('INSERT INTO "%s" VALUES (?, ?)' % table, rows)
+        conn.commit()
+        conn.close()
+
+    def test_per_domain_table_is_imported(self):
+        whois = '{\n  "domain_name": "MY-SITE.COM.TW",\n  "registrar": "Example"\n}'
+        self.create_legacy_table("my_site_com_tw", ZONE + ASN + [("whois", whois)])
+        conn = self.connect()
+        tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master "
+                                                 "WHERE type='table'")]
+        self.assertNotIn("my_site_com_tw", tables)
+        self.assertEqual(store.load_domain(conn, "my-site.com.tw"), store.group(ZONE + ASN))
+        state = store.load_state(conn, "my-site.com.tw")
+        self.assertEqual({serial for _, serial in state.values()}, {2022081501})
+        # the history starts from the imported zone records, without the
+        # ASN rows or the WHOIS blob
+        history = store.load_history(conn, "my-site.com.tw")
+        self.assertEqual(sorted((t, v, change) for _, _, change, t, v in history),
+                         sorted((t, v, "+") for t, v in ZONE))
+
+    def test_legacy_domain(self):
+        whois = '{\n  "domain_name": [\n    "MY-SITE.COM"\n  ]\n}'
+        self.assertEqual(store.legacy_domain("my_site_com", [("whois", whois)]), "my-site.com")
+        # a blob naming another domain is not trusted
+        self.assertEqual(store.legacy_domain("my_site_com", [("whois", '"domain_name": "a.com"')]),
+                         "my.site.com")
+        self.assertEqual(store.legacy_domain("_8591_com_tw", []), "8591.com.tw")
+
+
+class HistoryTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.conn = self.connect()
+        with mock.patch.object(store, "now", return_value=FIRST):
+            store.replace_records(self.conn, "example.com", ZONE + ASN, 2022081501)
+
+    def change_txt(self):
+        rows = [(t, '"v=spf1 mx -all"' if t == "TXT" else v) for t, v in ZONE]
+        with mock.patch.object(store, "now", return_value=SECOND):
+            return store.replace_records(self.conn, "example.com", rows, 2022081502,
+                                         store.ZONE_TYPES)
+
+    def test_only_the_changed_type_is_rewritten(self):
+        rowids = dict(self.conn.execute("SELECT record_value, rowid FROM records"))
+        self.assertEqual(self.change_txt(), ["TXT"])
+        after = dict(self.conn.execute("SELECT record_value, rowid FROM records"))
+        # the other rows stay where they were, with a new fetched_at
+        del rowids['"v=spf1 -all"']
+        self.assertEqual({v: after[v] for v in rowids}, rowids)
+        self.assertIn('"v=spf1 mx -all"', after)
+        state = store.load_state(self.conn, "example.com")
+        for t, _ in ZONE:
+            self.assertEqual(state[t], (SECOND, 2022081502), t)
+        # the ASN rows were not part of this refresh
+        self.assertEqual(state["ip"], (FIRST, 2022081501))
+
+    def test_only_the_changed_pairs_are_logged(self):
+        first = store.load_history(self.conn, "example.com")
+        self.assertEqual(sorted((t, v) for _, _, _, t, v in first), sorted(ZONE))
+        self.change_txt()
+        self.assertEqual(store.load_history(self.conn, "example.com", since=SECOND), [
+            (SECOND, 2022081502, "-", "TXT", '"v=spf1 -all"'),
+            (SECOND, 2022081502, "+", "TXT", '"v=spf1 mx -all"'),
+        ])
+
+    def test_records_as_of(self):
+        self.change_txt()
+        self.assertEqual(store.records_as_of(self.conn, "example.com", "2022-07-31T00:00:00+00:00"),
+                         {})
+        old = store.records_as_of(self.conn, "example.com", "2022-08-01T12:00:00+00:00")
+        self.assertEqual(old, store.group(sorted(ZONE)))
+        new = store.records_as_of(self.conn, "example.com", SECOND)
+        self.assertEqual(new["TXT"], ['"v=spf1 mx -all"'])
+        self.assertEqual({t: v for t, v in new.items() if t != "TXT"},
+                         {t: v for t, v in old.items() if t != "TXT"})
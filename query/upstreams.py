@@ -0,0 +1,456 @@
+"""Pool of upstream DNS resolvers for the report lookups.
+
+A lookup goes to the fastest healthy upstream first.  When that one has
+not answered within its DNSQUERY_DNS_HEDGE_PERCENTILE latency, the same
+query is also sent to the next upstream, and the first usable answer
+wins.  SERVFAIL, REFUSED and socket errors move on to the next upstream
+at once.  A lookup that gets no usable answer within DNSQUERY_DNS_TIMEOUT
+raises dns.exception.Timeout (or NoNameservers when every upstream
+failed), so callers can tell a resolver that did not answer from a name
+that does not exist (NXDOMAIN) or has no such record (NoAnswer).
+
+An upstream that fails FAILURES_DOWN times in a row is only tried after
+the healthy ones for the next DOWN_FOR seconds.  An upstream can carry a
+rate limit of its own (Upstream.limiter, see audit_domains); waiting for
+it before the first send does not count against the timeout.
+
+Queries go over UDP, or with DNSQUERY_DNS_TRANSPORT = "tcp" or "tls"
+over the pooled connections of pipeline.py.
+"""
+import asyncio
+import concurrent.futures
+import selectors
+import socket
+import threading
+import time
+from collections import Counter, deque
+
+import dns.asyncquery
+import dns.exception
+import dns.flags
+import dns.message
+import dns.name
+import dns.query
+import dns.rcode
+import dns.rdataclass
+import dns.rdatatype
+import dns.resolver
+from django.conf import settings
+
+from .pipeline import get_pipeline
+
+SAMPLES = 200
+MIN_SAMPLES = 10
+DEFAULT_HEDGE = 0.25
+FAILURES_DOWN = 3
+DOWN_FOR = 30
+EDNS_PAYLOAD = 1232
+# rcodes that answer the question; any other one is the upstream's failure
+FINAL_RCODES = (dns.rcode.NOERROR, dns.rcode.NXDOMAIN, dns.rcode.YXDOMAIN)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class Upstream:
+    def __init__(self, address, port=53):
+        self.address = address
+        self.port = port
+        self.family = socket.AF_INET6 if ":" in address else socket.AF_INET
+        self.counters = Counter()
+        self.failures = 0
+        self.down_until = 0.0
+        # a resolve.RateLimiter of the queries sent to this upstream
+        self.limiter = None
+        self._latencies = deque(maxlen=SAMPLES)
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return "%s#%d" % (self.address, self.port)
+
+    def pace(self):
+        if self.limiter is not None:
+            self.limiter.acquire()
+
+    async def pace_async(self):
+        if self.limiter is not None:
+            await self.limiter.acquire_async()
+
+    def healthy(self, now=None):
+        return self.down_until <= (time.monotonic() if now is None else now)
+
+    def percentile(self, share):
+        # the latency below which `share` of the recent answers came, or
+        # None until there are enough of them
+        with self._lock:
+            values = sorted(self._latencies)
+        if len(values) < MIN_SAMPLES:
+            return None
+        return values[min(len(values) - 1, int(len(values) * share))]
+
+    def answered(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+            self.counters["answers"] += 1
+            self.failures = 0
+            self.down_until = 0.0
+
+    def outpaced(self, seconds):
+        # another upstream answered first; the time waited so far is a
+        # lower bound of this one's latency
+        with self._lock:
+            self._latencies.append(seconds)
+            self.counters["outpaced"] += 1
+
+    def failed(self, kind):
+        with self._lock:
+            self.counters[kind] += 1
+            self.failures += 1
+            if self.failures >= FAILURES_DOWN:
+                self.down_until = time.monotonic() + DOWN_FOR
+
+
+def make_query(qname, rdtype):
+    if isinstance(qname, str):
+        qname = dns.name.from_text(qname)
+    if isinstance(rdtype, str):
+        rdtype = dns.rdatatype.from_text(rdtype)
+    return qname, rdtype, dns.message.make_query(qname, rdtype, use_edns=0,
+                                                 payload=EDNS_PAYLOAD)
+
+
+def answer(qname, rdtype, response):
+    # the Answer of a final response, or the exception dns.resolver
+    # raises for it
+    rcode = response.rcode()
+    if rcode == dns.rcode.NXDOMAIN:
+        raise dns.resolver.NXDOMAIN(qnames=[qname], responses={qname: response})
+    if rcode == dns.rcode.YXDOMAIN:
+        raise dns.resolver.YXDOMAIN()
+    result = dns.resolver.Answer(qname, rdtype, dns.rdataclass.IN, response)
+    if result.rrset is None:
+        raise dns.resolver.NoAnswer(response=response)
+    return result
+
+
+class UDPChannel:
+    # the UDP sockets of one exchange, one per upstream asked
+    def __init__(self, query, wire, deadline):
+        self.query = query
+        self.wire = wire
+        self.deadline = deadline
+        self.selector = selectors.DefaultSelector()
+        self.upstreams = {}
+
+    def send(self, upstream):
+        sock = socket.socket(upstream.family, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        try:
+            sock.connect((upstream.address, upstream.port))
+            sock.send(self.wire)
+        except OSError:
+            sock.close()
+            raise
+        self.selector.register(sock, selectors.EVENT_READ)
+        self.upstreams[sock] = upstream
+        return sock
+
+    def wait(self, socks, timeout):
+        # [(sock, response or exception)] of the answers that came in
+        results = []
+        for key, _ in self.selector.select(timeout):
+            sock = key.fileobj
+            upstream = self.upstreams[sock]
+            try:
+                response = dns.message.from_wire(sock.recv(65535))
+                if not self.query.is_response(response):
+                    continue
+                if response.flags & dns.flags.TC:
+                    response = dns.query.tcp(
+                        self.query, upstream.address, port=upstream.port,
+                        timeout=max(0.0, self.deadline - time.monotonic()))
+            except (OSError, dns.exception.DNSException) as e:
+                response = e
+            results.append((sock, response))
+        return results
+
+    def discard(self, sock):
+        self.selector.unregister(sock)
+        sock.close()
+
+    def close(self, socks):
+        for sock in socks:
+            sock.close()
+        self.selector.close()
+
+
+class StreamChannel:
+    # the same exchange over the pooled TCP or TLS connections
+    def __init__(self, pipeline, query, wire):
+        self.pipeline = pipeline
+        self.query = query
+        self.wire = wire
+
+    def send(self, upstream):
+        return self.pipeline.submit(upstream, self.wire)
+
+    def wait(self, futures, timeout):
+        done, _ = concurrent.futures.wait(futures, timeout,
+                                          concurrent.futures.FIRST_COMPLETED)
+        results = []
+        for future in done:
+            try:
+                response = dns.message.from_wire(future.result())
+                if not self.query.is_response(response):
+                    raise dns.exception.FormError("answer to another query")
+            except Exception as e:
+                response = e
+            results.append((future, response))
+        return results
+
+    def discard(self, future):
+        pass
+
+    def close(self, futures):
+        for future in futures:
+            future.cancel()
+
+
+class ResolverPool:
+    def __init__(self, upstreams, timeout=2.0, hedge_share=0.9, hedge_min=0.01,
+                 pipeline=None):
+        self.upstreams = list(upstreams)
+        self.timeout = timeout
+        self.hedge_share = hedge_share
+        self.hedge_min = hedge_min
+        self.pipeline = pipeline
+        self.counters = Counter()
+        self._lock = threading.Lock()
+
+    def ordered(self):
+        # healthy upstreams by median latency (untried ones first), then
+        # the failing ones, soonest back first
+        now = time.monotonic()
+        healthy = [u for u in self.upstreams if u.healthy(now)]
+        down = [u for u in self.upstreams if not u.healthy(now)]
+        healthy.sort(key=lambda u: u.percentile(0.5) or 0.0)
+        down.sort(key=lambda u: u.down_until)
+        return healthy + down
+
+    def hedge_delay(self, upstream):
+        delay = upstream.percentile(self.hedge_share)
+        if delay is None:
+            delay = DEFAULT_HEDGE
+        return min(max(delay, self.hedge_min), self.timeout)
+
+    def count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def resolve(self, qname, rdtype):
+        qname, rdtype, query = make_query(qname, rdtype)
+        return answer(qname, rdtype, self.exchange(query))
+
+    async def resolve_async(self, qname, rdtype):
+        qname, rdtype, query = make_query(qname, rdtype)
+        return answer(qname, rdtype, await self.exchange_async(query))
+
+    def settle(self, upstream, elapsed, response, errors):
+        # True when response answers the query; a failing upstream is
+        # noted in its health and in errors
+        if response.rcode() in FINAL_RCODES:
+            upstream.answered(elapsed)
+            return True
+        upstream.failed("servfail")
+        errors.append((str(upstream), self.pipeline is not None, upstream.port,
+                       dns.rcode.to_text(response.rcode()), response))
+        return False
+
+    def give_up(self, query, waiting, errors, timed_out=False):
+        for upstream, sent_at in waiting:
+            upstream.failed("timeout")
+        if waiting or timed_out or not errors:
+            self.count("timeouts")
+            raise dns.exception.Timeout(timeout=self.timeout)
+        self.count("failures")
+        raise dns.resolver.NoNameservers(request=query, errors=errors)
+
+    def channel(self, query, wire, deadline):
+        if self.pipeline is not None:
+            return StreamChannel(self.pipeline, query, wire)
+        return UDPChannel(query, wire, deadline)
+
+    def exchange(self, query):
+        wire = query.to_wire()
+        upstreams = self.ordered()
+        first = upstreams[0]
+        first.pace()
+        start = time.monotonic()
+        deadline = start + self.timeout
+        errors = []
+        waiting = {}
+        next_send = start
+        self.count("queries")
+        channel = self.channel(query, wire, deadline)
+        try:
+            while True:
+                now = time.monotonic()
+                if upstreams and now < deadline and (now >= next_send or not waiting):
+                    upstream = upstreams.pop(0)
+                    if upstream is not first:
+                        upstream.pace()
+                        now = time.monotonic()
+                    if waiting:
+                        self.count("hedged")
+                    upstream.counters["queries"] += 1
+                    try:
+                        token = channel.send(upstream)
+                    except OSError as e:
+                        upstream.failed("errors")
+                        errors.append((str(upstream), self.pipeline is not None, upstream.port, e, None))
+                        continue
+                    waiting[token] = (upstream, now)
+                    next_send = now + self.hedge_delay(upstream)
+                    continue
+                if not waiting or now >= deadline:
+                    self.give_up(query, waiting.values(), errors)
+                until = min(deadline, next_send) if upstreams else deadline
+                for token, result in channel.wait(list(waiting), max(0.0, until - now)):
+                    upstream, sent_at = waiting.pop(token)
+                    channel.discard(token)
+                    now = time.monotonic()
+                    if isinstance(result, Exception):
+                        upstream.failed("errors")
+                        errors.append((str(upstream), self.pipeline is not None, upstream.port, result, None))
+                    elif self.settle(upstream, now - sent_at, result, errors):
+                        for other, other_sent in waiting.values():
+                            other.outpaced(now - other_sent)
+                        return result
+                    next_send = now
+        finally:
+            channel.close(list(waiting))
+
+    async def ask_async(self, upstream, query, wire, deadline):
+        if self.pipeline is not None:
+            response = dns.message.from_wire(
+                await asyncio.wrap_future(self.pipeline.submit(upstream, wire)))
+            if not query.is_response(response):
+                raise dns.exception.FormError("answer to another query")
+            return response
+        # plain loop socket calls rather than dns.asyncquery, whose
+        # asyncio backend breaks when a hedged query is cancelled
+        loop = asyncio.get_running_loop()
+        with socket.socket(upstream.family, socket.SOCK_DGRAM) as sock:
+            sock.setblocking(False)
+            sock.connect((upstream.address, upstream.port))
+            await loop.sock_sendall(sock, wire)
+            while True:
+                response = dns.message.from_wire(await loop.sock_recv(sock, 65535))
+                if query.is_response(response):
+                    break
+        if response.flags & dns.flags.TC:
+            response = await dns.asyncquery.tcp(query, upstream.address,
+                                                timeout=max(0.0, deadline - time.monotonic()),
+                                                port=upstream.port)
+        return response
+
+    async def exchange_async(self, query):
+        wire = query.to_wire()
+        upstreams = self.ordered()
+        first = upstreams[0]
+        await first.pace_async()
+        start = time.monotonic()
+        deadline = start + self.timeout
+        errors = []
+        waiting = {}
+        timed_out = False
+        next_send = start
+        self.count("queries")
+        try:
+            while True:
+                now = time.monotonic()
+                if upstreams and now < deadline and (now >= next_send or not waiting):
+                    upstream = upstreams.pop(0)
+                    if upstream is not first:
+                        await upstream.pace_async()
+                        now = time.monotonic()
+                    if waiting:
+                        self.count("hedged")
+                    upstream.counters["queries"] += 1
+                    task = asyncio.ensure_future(self.ask_async(upstream, query, wire, deadline))
+                    waiting[task] = (upstream, now)
+                    next_send = now + self.hedge_delay(upstream)
+                    continue
+                if not waiting or now >= deadline:
+                    self.give_up(query, waiting.values(), errors, timed_out)
+                until = min(deadline, next_send) if upstreams else deadline
+                done, _ = await asyncio.wait(list(waiting), timeout=max(0.0, until - now),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    upstream, sent_at = waiting.pop(task)
+                    now = time.monotonic()
+                    try:
+                        response = task.result()
+                    except dns.exception.Timeout:
+                        # a TCP retry that ran into the deadline
+                        upstream.failed("timeout")
+                        timed_out = True
+                        continue
+                    except (OSError, dns.exception.DNSException) as e:
+                        upstream.failed("errors")
+                        errors.append((str(upstream), self.pipeline is not None, upstream.port, e, None))
+                        next_send = now
+                        continue
+                    if self.settle(upstream, now - sent_at, response, errors):
+                        for other, other_sent in waiting.values():
+                            other.outpaced(now - other_sent)
+                        return response
+                    next_send = now
+        finally:
+            for task in waiting:
+                task.cancel()
+
+    def stats(self):
+        # the pool's counters and, per upstream, (name, healthy, median
+        # latency, hedge percentile latency, counters)
+        with self._lock:
+            counters = dict(self.counters)
+        now = time.monotonic()
+        return counters, [(str(u), u.healthy(now), u.percentile(0.5),
+                           u.percentile(self.hedge_share), dict(u.counters))
+                          for u in self.upstreams]
+
+
+def configured_upstreams():
+    # DNSQUERY_NAMESERVERS, or the nameservers of the system resolv.conf;
+    # an entry is an address or an (address, port) pair
+    port = getattr(settings, "DNSQUERY_NAMESERVER_PORT", 53)
+    nameservers = getattr(settings, "DNSQUERY_NAMESERVERS", [])
+    if not nameservers:
+        nameservers = dns.resolver.Resolver().nameservers
+    upstreams = []
+    for entry in nameservers:
+        if isinstance(entry, (tuple, list)):
+            upstreams.append(Upstream(entry[0], entry[1]))
+        else:
+            upstreams.append(Upstream(entry, port))
+    return upstreams
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            transport = getattr(settings, "DNSQUERY_DNS_TRANSPORT", "udp")
+            pipeline = None
+            if transport in ("tcp", "tls"):
+                pipeline = get_pipeline(transport,
+                                        getattr(settings, "DNSQUERY_DNS_CONNECTIONS", 2),
+                                        getattr(settings, "DNSQUERY_DNS_TLS_NAME", None))
+            _pool = ResolverPool(
+                configured_upstreams(),
+                timeout=getattr(settings, "DNSQUERY_DNS_TIMEOUT", 2.0),
+                hedge_share=getattr(settings, "DNSQUERY_DNS_HEDGE_PERCENTILE", 0.9),
+                hedge_min=getattr(settings, "DNSQUERY_DNS_HEDGE_MIN", 0.01),
+                pipeline=pipeline)
+        return _pool
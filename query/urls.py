@@ -6,4 +6,12 @@ urlpatterns = [
     path('search/', views.search, name='search'),
     path('search/whoisdetails/', views.whoisdetails, name='whoisdetails'),
     path('search/nsdetails/', views.nsdetails, name='nsdetails'),
+    path('search/history/', views.history, name='history'),
+    path('async/search/', views.search_async, name='search_async'),
+    path('async/search/whoisdetails/', views.whoisdetails_async, name='whoisdetails_async'),
+    path('async/search/nsdetails/', views.nsdetails_async, name='nsdetails_async'),
+    path('async/search/history/', views.history, name='history_async'),
+    path('cachestats/', views.cachestats, name='cachestats'),
+    path('metrics/', views.prometheus, name='metrics'),
+    path('api/v1/domain/<str:name>', views.api_domain, name='api_domain'),
 ]
@@ -1,21 +1,20 @@
-import ipwhois.exceptions
-from django.shortcuts import render
-from django.http import HttpResponse
+import logging
+from django.shortcuts import redirect
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.template import loader
-from ipwhois.net import Net
-from ipwhois.asn import IPASN
-import sys
-import threading
-from time import sleep
-import whois
-import dns.zone
-import dns.resolver
-import dns.reversename
+from django.utils.cache import get_conditional_response, patch_cache_control
+import contextvars
+from concurrent.futures import as_completed
 import re
-import sqlite3
 from datetime import datetime, timezone
-import pytz
 from sqlite3 import Error
+from . import checks, metrics, snapshot, store, whoiscache
+from .dnscache import get_cache
+from .upstreams import get_pool
+from .refresh import live_serial, refresh, stale, version
+from .report import ReportContext, blocking_pool, recent_context, remember, run_blocking
+
+logger = logging.getLogger(__name__)
 
 
 # Create your views here.
@@ -23,504 +22,196 @@ def index(request):
     template = loader.get_template('home.html')
     context = {}
     return HttpResponse(template.render(context, request))
-def search(request):
-    global domain
+def cachestats(request):
+    return JsonResponse(get_cache().stats())
+def prometheus(request):
+    return HttpResponse(metrics.render(get_cache().stats(), get_pool().stats(),
+                                       snapshot.get_store().stats()),
+                        content_type="text/plain; version=0.0.4; charset=utf-8")
+def stored_records(ctx):
+    # the domain's stored records as a snapshot.DomainReport; query.db is
+    # only read (and refreshed) when there is no fresh snapshot
+    serial = live_serial(ctx)
+    snapshots = snapshot.get_store()
+    report = snapshots.get(ctx.domain, serial)
+    if report is not None and not stale(ctx, snapshot=report):
+        ctx.stats.add("snapshot_hits")
+        return report
+    conn = store.connect()
     try:
-        domain = request.POST["domain"]
-    except Exception:
-        pass
-    template = loader.get_template('ans.html')
-    try:
-        dns.resolver.resolve(domain, "A")
-    except dns.resolver.NXDOMAIN:
-        sys.exit()
-    except dns.resolver.NoAnswer:
-        pass
+        changed = refresh(ctx, conn)
+        logger.debug("report %s: rewrote %s", ctx.domain, changed or "nothing")
+    except Error as e:
+        logger.warning("report %s: storing records failed: %r", ctx.domain, e)
+    # every stored record of the domain, read in one SELECT
+    report = snapshot.DomainReport(ctx.domain, serial, store.load_domain(conn, ctx.domain),
+                                   store.load_state(conn, ctx.domain),
+                                   whoiscache.cached(ctx.domain))
+    snapshots.put(report)
+    return report
 
-    def create_connection(db_file):
-        conn = None
-        try:
-            conn = sqlite3.connect(db_file)
-            return conn
-        except Error as e:
-            print(e)
-        return conn
+def report_time():
+    # pytz loads on the first report, not with the module
+    import pytz
+    return datetime.now(pytz.timezone("Asia/Taipei")).strftime('%Y/%m/%d %H:%M:%S')
 
-    def create_table(conn, create_table_sql):
-        try:
-            c = conn.cursor()
-            c.execute(create_table_sql)
-        except Error as e:
-            print(e)
+def report_context(ctx):
+    # everything after the DNS round trips: SQLite, WHOIS and IPASN;
+    # the caller has checked that the domain exists
+    domain = ctx.domain
+    time = report_time()
+    context = checks.build_report(ctx, stored_records(ctx))
+    context["time"] = time
+    context["mode"] = 1
+    remember(ctx)
+    metrics.count_lookups(ctx.stats)
+    logger.info("report %s: %s", domain, dict(ctx.stats))
+    return context
 
-    def create_record(conn, domain, records):
-        sql = ''' INSERT INTO '''+domain+''' (record_type, record_value)
-                  VALUES(?,?) '''
-        cur = conn.cursor()
-        try:
-            cur.execute(sql, records)
-            conn.commit()
-        except Error as e:
-            print(e)
+def render_section(name, context, request):
+    return loader.render_to_string("report/%s.html" % name, context, request)
 
-    def main():
-        database = "query.db"
-        domain2 = record_search("domain")
-        sql_create_domain_table = """ CREATE TABLE IF NOT EXISTS """+domain2+""" (
-                                                record_type text,
-                                                record_value text
-                                            ); """
-        # create a database connection
-        conn = create_connection(database)
-        if soa_check(domain2) == "same":
-            print("same")
-        else:
-            with conn:
-                try:
-                    cursor = conn.cursor()
-                    cursor.execute('drop table '+domain2)
-                except Exception:
-                    pass
-                create_table(conn, sql_create_domain_table)
-                # trivial records
-                type = ["A", "AAAA", "NS", "MX", "TXT", "SOA"]
-                for x in type:
-                    for num in range(len(record_search(x))):
-                        records = (x, record_search(x)[num])
-                        create_record(conn, domain2, records)
-                # whois
-                w = str(whois.whois(domain)).lower()
-                records = ("whois", w)
-                create_record(conn, domain2, records)
-                # asn
-                type = ["ip", "asn", "country", "registry", "description"]
-                for x in type:
-                    if as_search(x) == "private_error":
-                        records = (x, "private_error")
-                        create_record(conn, domain2, records)
-                    else:
-                        for num in range(len(as_search(x))):
-                            records = (x, as_search(x)[num])
-                            create_record(conn, domain2, records)
+def stream_report(request, domain):
+    # the page shell goes out before any lookup; every section follows as
+    # a <template> the shell's script moves into place once it is ready
+    yield loader.render_to_string("ans_stream.html", {
+        "domain": domain,
+        "time": report_time(),
+        "sections": [name for name, _ in checks.SECTIONS],
+    }, request)
+    if not checks.valid_domain(domain):
+        yield render_section("invalid", {"domain": domain}, request)
+        yield render_section("foot", {}, request)
+        return
+    ctx = checks.plan_report(ReportContext(domain))
+    if not checks.domain_exists(ctx):
+        yield render_section("nxdomain", {"domain": domain}, request)
+        yield render_section("foot", {}, request)
+        return
 
-    def record_search(type):
-        domain2 = re.sub("\\.","_", domain)
-        domain2 = re.sub(r"-", "_", domain2)
-        if re.search(r"^\d", domain2):
-            domain2 = str("_"+domain2)
-        record = []
-        if type == "domain":
-            return domain2
+    def show(name, context):
+        # context is None when the section failed
+        if context is None:
+            html = render_section("error", {"section": name}, request)
         else:
-            try:
-                q = dns.resolver.resolve(domain, type)
-                for data in q:
-                    record.append(str(data))
-            except Exception:
-                record.append("none")
-            return record
+            context["domain"] = domain
+            html = render_section(name, context, request)
+        return '<template id="%s-data">%s</template><script>show("%s")</script>\n' % (
+            name, html, name)
 
-    def soa_check(domain2):
-        conn = sqlite3.connect("query.db")
-        try:
-            q = dns.resolver.resolve(domain, "SOA")
-            for data in q:
-                serial = data.serial
-        except Exception:
-            return "none"
-        cursor = conn.cursor()
-        try:
-            cursor.execute('select record_value from '+domain2+' where record_type="SOA"')
-            result = cursor.fetchall()
-        except Exception:
-            return "none"
-        if serial:
-            if re.search(str(serial), str(result)):
-                return "same"
-
-    def database_search(type):
-        result = []
-        domain2 = record_search("domain")
-        conn = sqlite3.connect("query.db")
-        cursor = conn.cursor()
-        cursor.execute('select record_value from '+domain2+' where record_type="'+type+'"')
-        tempresult = cursor.fetchall()
-        cursor.close()
-        for row in tempresult:
-            if str(row[0]) == "none":
-                return "none"
-            elif str(row[0]) == "private_error":
-                return "private_error"
-            else:
-                result.append(row[0])
-        return result
-
-    def whois_ns_compare():
-        x = set()
-        w = str(whois.whois(domain).name_servers).lower()
-        if '\'' in w:
-            replacements = [
-                ("\'", ""),
-                ("\[", ""),
-                ("\]", ""),
-                ("\,", "")
-            ]
-            for old, new in replacements:
-                w = re.sub(old, new, w)
-            for ns in w.split():
-                x.add(ns)
+    # the zone records are those just resolved; the ASN rows (and the NS IP
+    # check built on them) wait for the stored records to be refreshed
+    zone = store.group(checks.zone_records(ctx))
+    pool = blocking_pool()
+    stored = pool.submit(contextvars.copy_context().run, stored_records, ctx)
+    pending = {stored: None}
+    later = []
+    for name, section in checks.SECTIONS:
+        if name in ("asn", "ns_ip"):
+            later.append((name, section))
         else:
-            for ns in w.split():
-                x.add(ns)
-        x = list(x)
-        y = []
-        z = []
-        for num in x:
-            if re.search(r"\d$", num):
-                z.append(num)
-        for num in z:
-            x.remove(num)
-        ns = dns.resolver.resolve(domain, "NS")
-        for data in ns:
-            data = re.sub(r"\.$", "", str(data))
-            y.append(str(data))
-        x = set(x)
-        y = set(y)
-        joined = x.union(y)
-        if len(joined) != len(x):
-            return "misconfigured"
-        elif len(joined) != len(y):
-            return "misconfigured"
+            pending[pool.submit(contextvars.copy_context().run, section, ctx, zone)] = name
+    for future in as_completed(pending):
+        name = pending[future]
+        if name is None:
+            try:
+                results = [(n, section(ctx, future.result())) for n, section in later]
+            except Exception as e:
+                logger.warning("report %s: stored records failed: %r", domain, e)
+                results = [(n, None) for n, section in later]
         else:
-            return "correct"
-
-
-    def ns_ip_compare():
-        domain2 = record_search("domain")
-        conn = sqlite3.connect("query.db")
-        cursor = conn.cursor()
-        cursor.execute('select record_value from '+domain2+' where record_type="ip"')
-        result = cursor.fetchall()
-        cursor.close()
-        ip = []
-        for row in result:
-            ip.append(row[0])
-        if len(ip) == 1:
-            return "correct"
-        try:
-            ip_set = set()
-            for num in ip:
-                string = re.sub(r".\d+$", "", str(num))
-                ip_set.add(string)
-            if len(ip_set) != len(ip):
-                return "misconfigured"
-            else:
-                return "correct"
-        except Exception:
-            return "none"
-
-    def as_search(type):
-        ip_list = set()
-        asn_list = []
-        country = []
-        registry = []
-        description = []
-        try:
-            ns = dns.resolver.resolve(domain, "NS")
-            for ns_data in ns:
-                name = str(ns_data)
-                a = dns.resolver.resolve(name, "A")
-                for a_data in a:
-                    ip_list.add(str(a_data))
-            ip_list = list(ip_list)
-            for num in range(len(ip_list)):
-                net = Net(ip_list[num])
-                obj = IPASN(net)
-                results = obj.lookup()
-                asn_list.append(results['asn'])
-                country.append(results['asn_country_code'])
-                registry.append(results['asn_registry'])
-                description.append(results['asn_description'])
-        except ipwhois.exceptions.IPDefinedError:
-            print("error")
-            return "private_error"
-        if type == "ip":
-            return ip_list
-        if type == "asn":
-             return asn_list
-        if type == "country":
-            return country
-        if type == "registry":
-            return registry
-        if type == "description":
-            return description
-
-    def regi_search():
-        domain2 = record_search("domain")
-        conn = sqlite3.connect("query.db")
-        cursor = conn.cursor()
-        cursor.execute('select record_value from '+domain2+' where record_type="whois"')
-        result = cursor.fetchall()
-        cursor.close()
-        for row in result:
-            w = row[0]
-        with open("whois.txt", "w", encoding="utf-8") as f:
-            f.write(w)
-        with open("whois.txt", "r", encoding="utf-8") as f:
-            lines = f.readlines()
-            ans = 0
-        for num in range(len(lines)):
             try:
-                x = re.search(r"\bregistrar\b", (lines[num])).groups()
-                if x == ():
-                    regi = re.sub(r'( "registrar": )', '', lines[num])
-                    regi = re.sub(r",", '', regi)
-                    try:
-                        re.search("null", regi).groups()
-                        break
-                    except AttributeError:
-                        ans = 1
-                        return regi.upper()
-            except AttributeError:
-                pass
-        if ans != 1:
-            return "none"
+                results = [(name, future.result())]
+            except Exception as e:
+                logger.warning("report %s: %s failed: %r", domain, name, e)
+                results = [(name, None)]
+        for name, context in results:
+            yield show(name, context)
+    yield render_section("foot", {}, request)
+    remember(ctx)
+    metrics.count_lookups(ctx.stats)
+    logger.info("report %s: %s", domain, dict(ctx.stats))
 
-    def exp_date():
-        with open("whois.txt", "r", encoding="utf-8") as f:
-            lines = f.readlines()
-            num = 0
-            ans = 0
-        while num < len(lines):
-            try:
-                x = re.search(r"\bexpiration_date\b", (lines[num])).groups()
-                if x == ():
-                    exp = re.sub(r'( "expiration_date": )', '', lines[num])
-                    exp = re.sub(r",", '', exp)
-                    try:
-                        re.search("null", exp).groups()
-                        break
-                    except AttributeError:
-                        ans = 1
-                    if "[" in exp:
-                        num += 1
-                        exp = re.sub(r'^\s*', '', lines[num])
-                        exp = re.sub(r",", '', exp)
-                        return exp
-                    else:
-                        return exp
-            except AttributeError:
-                pass
-            num += 1
-        if ans != 1:
-            return "none"
+def requested_domain(request):
+    # the search form posts the domain; the details links of a report
+    # carry it in the query string
+    return (request.POST.get("domain") or request.GET.get("domain") or "").strip()
 
-    def o365check(type):
-        if type == "auto":
-            try:
-                cname = dns.resolver.resolve("autodiscover."+domain, "CNAME")
-                for data in cname:
-                    if re.search(r"autodiscover.outlook.com", str(data)):
-                        return "correct"
-                    else:
-                        return "misconfigured"
-            except Exception:
-                return "misconfigured"
-        if type == "msoid":
-            try:
-                cname = dns.resolver.resolve("msoid."+domain, "CNAME")
-                for data in cname:
-                    if re.search(r"clientconfig.microsoftonline-p.net", str(data)):
-                        return "correct"
-                    else:
-                        pass
-            except Exception:
-                pass
-        if type == "lync":
-            try:
-                cname = dns.resolver.resolve("lyncdiscover."+domain, "CNAME")
-                for data in cname:
-                    if re.search(r"webdir.online.lync.com", str(data)):
-                        return "correct"
-                    else:
-                        pass
-            except Exception:
-                pass
-        if type == "365mx":
-            try:
-                ans = 0
-                mx = dns.resolver.resolve(domain, "MX")
-                for data in mx:
-                    if re.search(r"mail.protection.outlook.com", str(data)):
-                        ans = 1
-                        return "correct"
-                        break
-                    elif re.search(r"protection.outlook.com", str(data)):
-                        ans = 1
-                        return "update"
-                        break
-                    else:
-                        pass
-                if ans != 1:
-                    return "misconfigured"
-            except Exception:
-                return "misconfigured"
-        if type == "spf":
-            try:
-                ans = 0
-                spf = dns.resolver.resolve(domain, "txt")
-                for data in spf:
-                    if re.search(r"include:spf.protection.outlook.com", str(data)):
-                        ans = 1
-                        return "correct"
-                        break
-                    else:
-                        pass
-                if ans != 1:
-                    return "misconfigured"
-            except Exception:
-                return "misconfigured"
-        if type == "sipdir":
-            try:
-                tls = dns.resolver.resolve("_sip._tls."+domain, "SRV")
-                if tls:
-                    return "correct"
-            except Exception:
-                return "misconfigured"
-        if type == "sipfed":
-            try:
-                tcp = dns.resolver.resolve("_sipfederationtls._tcp."+domain, "SRV")
-                if tcp:
-                    return "correct"
-            except Exception:
-                return "misconfigured"
+@metrics.timed_view
+def search(request):
+    domain = requested_domain(request)
+    if not domain:
+        return redirect("index")
+    return StreamingHttpResponse(stream_report(request, domain))
 
-    def mail_search(type):
-        domain_exchange = []
-        exchange_list = []
-        ans = 0
-        if type == "search":
-            with open("mail_list.txt", "r", encoding="utf-8") as read:
-                for line in read:
-                    split = line.split(" ")
-                    domain_exchange.extend([split[0]])
-                    exchange_list.extend([split[1]])
-            try:
-                m = dns.resolver.resolve(domain, "MX")
-                mx_list = []
-                pref_list = []
-                for rdata in m:
-                    mx = [rdata.exchange]
-                    pref = [rdata.preference]
-                    mx_list.extend(mx)
-                    pref_list.extend(pref)
-                mx_name = str(mx_list[(pref_list.index(min(pref_list)))])
-            except dns.resolver.NoAnswer:
-                return "misconfigured"
-            with open("mail_list.txt", "r", encoding="utf-8") as file_path:
-                for count, line in enumerate(file_path):
-                    pass
-            count += 1
-            num = 0
-            while num < count:
-                if domain_exchange[num] in mx_name:
-                    ans = 1
-                    if num == 3:
-                        return "Office_365"
-                    elif num == 1 :
-                        return "Gmail"
-                    elif num == 2 :
-                        return "Gmail"
-                    elif num == 0:
-                        return "Google_Workspace"
-                    elif num == 5:
-                        return "Amazon_SES"
-                    elif num == 6:
-                        return "Yahoo!_Mail"
-                    return exchange_list[num]
-                else:
-                    num += 1
-            if ans == 0:
-                return "misconfigured"
+def report_etag(ctx, report=None):
+    serial, stamp = version(ctx, snapshot=report)
+    if stamp is not None:
+        stamp = int(datetime.fromisoformat(stamp).timestamp())
+    return '"%s-%s"' % (serial, stamp)
 
+def api_headers(response, ctx, etag):
+    response["ETag"] = etag
+    ttl = ctx.plan.min_ttl()
+    if ttl is not None:
+        patch_cache_control(response, public=True, max_age=ttl)
+    return response
 
-    def www_check():
-        try:
-            a = dns.resolver.resolve("www."+domain, "A")
-            if a:
-                return "correct"
-        except Exception:
-            return "none"
-    time = datetime.now(pytz.timezone("Asia/Taipei"))
-    main()
-    context = {
-        "domain": domain,
-        "a": database_search("A"),
-        "aaaa": database_search("AAAA"),
-        "ns": database_search("NS"),
-        "mx": database_search("MX"),
-        "txt": database_search("TXT"),
-        "soa": database_search("SOA"),
-        "whois_ns": whois_ns_compare(),
-        "ns_ip": ns_ip_compare(),
-        "ip": database_search("ip"),
-        "asn": database_search("asn"),
-        "country": database_search("country"),
-        "registry": database_search("registry"),
-        "description": database_search("description"),
-        "registrar": regi_search(),
-        "exp_date": exp_date(),
-        "auto": o365check("auto"),
-        "msoid": o365check("msoid"),
-        "lync": o365check("lync"),
-        "365mx": o365check("365mx"),
-        "spf": o365check("spf"),
-        "sipdir": o365check("sipdir"),
-        "sipfed": o365check("sipfed"),
-        "mail_search": mail_search("search"),
-        "www": www_check(),
-        "wans": "http://www."+domain,
-        "time": time.strftime('%Y/%m/%d %H:%M:%S'),
-        "mode": 1,
+@metrics.timed_view
+def api_domain(request, name):
+    # the search report as JSON; the ETag follows the SOA serial and the
+    # time the stored records and WHOIS were fetched, so pollers get a 304
+    # without any WHOIS, IPASN or SQLite writes while nothing is stale
+    if not checks.valid_domain(name):
+        return JsonResponse({"domain": name, "error": "invalid domain name"}, status=400)
+    ctx = checks.plan_report(ReportContext(store.domain_key(name)))
+    report = snapshot.get_store().get(ctx.domain, live_serial(ctx))
+    if report is not None:
+        record = report.whois
+        fresh = not stale(ctx, snapshot=report)
+    else:
+        record = whoiscache.cached(ctx.domain)
+        fresh = not stale(ctx)
+    if fresh and record is not None and whoiscache.fresh(record):
+        etag = report_etag(ctx, report)
+        # None unless the client already holds this version
+        response = get_conditional_response(request, etag=etag)
+        if response is not None:
+            metrics.count_lookups(ctx.stats)
+            return api_headers(response, ctx, etag)
+    if not checks.domain_exists(ctx):
+        return JsonResponse({"domain": ctx.domain, "error": "NXDOMAIN"}, status=404)
+    context = report_context(ctx)
+    response = JsonResponse(context, json_dumps_params={"ensure_ascii": False})
+    report = snapshot.get_store().get(ctx.domain, live_serial(ctx))
+    return api_headers(response, ctx, report_etag(ctx, report))
 
-    }
+@metrics.timed_view
+async def search_async(request):
+    domain = requested_domain(request)
+    if not domain:
+        return redirect("index")
+    template = loader.get_template('ans.html')
+    context = {"domain": domain, "time": report_time()}
+    if not checks.valid_domain(domain):
+        return HttpResponse("".join(render_section(name, context, request)
+                                    for name in ("head", "invalid", "foot")))
+    ctx = await checks.plan_report_async(ReportContext(domain))
+    if not checks.domain_exists(ctx):
+        return HttpResponse("".join(render_section(name, context, request)
+                                    for name in ("head", "nxdomain", "foot")))
+    context = await run_blocking(report_context, ctx)
     return HttpResponse(template.render(context, request))
 
-def whoisdetails(request):
-    global domain
-    ns_ans = []
-    missing = []
-    whoishtml = []
-    template = loader.get_template('whois.html')
-    x = set()
-    w = str(whois.whois(domain).name_servers).lower()
-    if '\'' in w:
-        replacements = [
-            ("\'", ""),
-            ("\[", ""),
-            ("\]", ""),
-            ("\,", "")
-        ]
-        for old, new in replacements:
-            w = re.sub(old, new, w)
-        for ns in w.split():
-            x.add(ns)
-    else:
-        for ns in w.split():
-            x.add(ns)
-    x = list(x)
+def whois_details(ctx):
+    domain = ctx.domain
+    record = ctx.whois()
+    x = set(record.name_servers)
     y = []
-    z = []
-    for num in x:
-        if re.search(r"\d$", num):
-            z.append(num)
-    for num in z:
-        x.remove(num)
-    ns = dns.resolver.resolve(domain, "NS")
+    ns = ctx.resolve(domain, "NS")
     for data in ns:
         data = re.sub(r"\.$", "", str(data))
         y.append(str(data))
-    x = set(x)
     y = set(y)
     joined = x.union(y)
     error = 0
@@ -538,6 +229,8 @@ def whoisdetails(request):
         else:
             error = 1
             ns_error.append(num)
+    if record.failed():
+        error = 2
     context = {
         "whois_list": list(x),
         "ns_list": list(y),
@@ -545,24 +238,81 @@ def whoisdetails(request):
         "ns_error": ns_error,
         "error": error,
     }
+    return context
+
+@metrics.timed_view
+def whoisdetails(request):
+    domain = requested_domain(request)
+    if not checks.valid_domain(domain):
+        return redirect("index")
+    template = loader.get_template('whois.html')
+    context = whois_details(recent_context(domain))
     return HttpResponse(template.render(context, request))
 
-def nsdetails(request):
-    global domain
+@metrics.timed_view
+async def whoisdetails_async(request):
+    domain = requested_domain(request)
+    if not checks.valid_domain(domain):
+        return redirect("index")
+    template = loader.get_template('whois.html')
+    ctx = recent_context(domain)
+    ctx.plan.add(domain, "NS")
+    await ctx.plan.resolve_async()
+    context = await run_blocking(whois_details, ctx)
+    return HttpResponse(template.render(context, request))
+
+def history_time(value):
+    # an ISO date or time from the query string, as the UTC timestamps of
+    # record_history; a date means its start
+    if not value:
+        return None
+    when = datetime.fromisoformat(value.strip())
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return when.astimezone(timezone.utc).isoformat(timespec="seconds")
+
+@metrics.timed_view
+def history(request):
+    # what changed on a domain since ?since=, and its zone as of ?at=
+    domain = store.domain_key(requested_domain(request))
+    if not checks.valid_domain(domain):
+        return redirect("index")
+    template = loader.get_template('history.html')
+    try:
+        since = history_time(request.GET.get("since"))
+        at = history_time(request.GET.get("at"))
+    except ValueError:
+        return HttpResponse("since and at take ISO dates or times", status=400)
+    conn = store.connect()
+    context = {
+        "domain": domain,
+        "since": since,
+        "at": at,
+        "changes": store.load_history(conn, domain, since),
+        "zone": sorted(store.records_as_of(conn, domain, at).items()) if at else None,
+    }
+    return HttpResponse(template.render(context, request))
+
+def ns_details(ctx):
+    # expects the NS records, their A records and the PTRs of those to be
+    # resolved already
     ns_data = []
     ip_data = []
     check = []
     duplist = set()
     space = []
-    template = loader.get_template('ns.html')
-    ns = dns.resolver.resolve(domain, "NS")
+    ns = ctx.resolve(ctx.domain, "NS")
     for data in ns:
         ns_data.append(str(data))
     for num in range(len(ns_data)):
-        ip = dns.resolver.resolve(ns_data[num], "A")
+        try:
+            ip = ctx.resolve(ns_data[num], "A")
+        except Exception:
+            # a dangling NS host is listed without addresses
+            ip = []
         ip_data.append("IP of "+ns_data[num]+" :")
         for data in ip:
-            ip_data.append(str(data))
+            ip_data.append("%s  PTR: %s" % (data, checks.ptr_name(ctx.plan, str(data))))
             string = re.sub(r".\d+$", "", str(data))
             check.append(string)
     for x in check:
@@ -581,5 +331,38 @@ def nsdetails(request):
         "duplicates": duplist,
         "check": quicktest(),
     }
+    return context
+
+@metrics.timed_view
+def nsdetails(request):
+    domain = requested_domain(request)
+    if not checks.valid_domain(domain):
+        return redirect("index")
+    template = loader.get_template('ns.html')
+    ctx = recent_context(domain)
+    ctx.plan.add(domain, "NS")
+    ctx.plan.resolve()
+    checks.plan_nameservers(ctx)
+    ctx.plan.resolve()
+    checks.sweep_ptrs(ctx.plan, ctx.ns_ips())
+    context = ns_details(ctx)
+    context["ns_auth"] = ctx.ns_probe()
+    return HttpResponse(template.render(context, request))
+
+@metrics.timed_view
+async def nsdetails_async(request):
+    domain = requested_domain(request)
+    if not checks.valid_domain(domain):
+        return redirect("index")
+    template = loader.get_template('ns.html')
+    ctx = recent_context(domain)
+    ctx.plan.add(domain, "NS")
+    await ctx.plan.resolve_async()
+    checks.plan_nameservers(ctx)
+    await ctx.plan.resolve_async()
+    checks.plan_ptrs(ctx.plan, ctx.ns_ips())
+    await ctx.plan.resolve_async()
+    context = ns_details(ctx)
+    context["ns_auth"] = await run_blocking(ctx.ns_probe)
     return HttpResponse(template.render(context, request))
 
@@ -0,0 +1,52 @@
+"""Background warm-up of a freshly started worker.
+
+With DNSQUERY_WARMUP set, QueryConfig.ready starts a thread that does
+the first-use work of a report before the first request has to: the
+upstream pool, the rdata classes of the checked record types, the
+mail-provider table, the SQLite schema and ASN prefixes, and the WHOIS
+and IPASN libraries the views only import when a check first needs
+them.  Requests are served meanwhile; whatever is not warm yet is done
+by the request that needs it, as without the warm-up.
+"""
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+RDTYPES = ("A", "AAAA", "NS", "MX", "TXT", "SOA", "CNAME", "SRV")
+
+
+def warm_up():
+    import dns.rdata
+    import dns.rdataclass
+    import dns.rdatatype
+
+    from . import asncache, mailproviders, store
+    from .upstreams import get_pool
+
+    start = time.perf_counter()
+    get_pool()
+    for rdtype in RDTYPES:
+        dns.rdata.get_rdata_class(dns.rdataclass.IN, dns.rdatatype.from_text(rdtype))
+    mailproviders.get_table()
+    store.connect()
+    asncache.get_cache()
+    import ipwhois.asn  # noqa: F401
+    import ipwhois.net  # noqa: F401
+    import pytz  # noqa: F401
+    import whois  # noqa: F401
+    logger.info("warm-up done in %.0f ms", (time.perf_counter() - start) * 1000)
+
+
+def run():
+    try:
+        warm_up()
+    except Exception:
+        logger.exception("warm-up failed")
+
+
+def start():
+    thread = threading.Thread(target=run, name="warmup", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,122 @@
+"""WHOIS lookups, parsed once and cached per domain.
+
+The registrar, expiration date and name servers of a domain are kept in
+the whois table of query.db for DNSQUERY_WHOIS_TTL seconds, so every
+worker shares them.  Concurrent lookups of one domain wait for a single
+WHOIS query.
+"""
+import logging
+import re
+import threading
+from datetime import datetime, timedelta, timezone
+
+from django.conf import settings
+
+from . import metrics, store
+
+logger = logging.getLogger(__name__)
+
+# striped so a bulk audit does not grow one lock per domain
+_locks = [threading.Lock() for _ in range(64)]
+
+
+class WhoisRecord:
+    def __init__(self, domain, registrar=None, expiration_date=None,
+                 name_servers=(), fetched_at=None):
+        self.domain = store.domain_key(domain)
+        self.registrar = registrar
+        self.expiration_date = expiration_date
+        self.name_servers = list(name_servers)
+        self.fetched_at = fetched_at
+
+    @classmethod
+    def parse(cls, domain, w):
+        return cls(domain,
+                   registrar=first(w.registrar),
+                   expiration_date=first(w.expiration_date),
+                   name_servers=name_servers(w.name_servers),
+                   fetched_at=store.now())
+
+    def failed(self):
+        # the stand-in fetch returns when WHOIS did not answer
+        return self.fetched_at is None
+
+    def age(self):
+        if self.fetched_at is None:
+            return None
+        return datetime.now(timezone.utc) - datetime.fromisoformat(self.fetched_at)
+
+
+def first(value):
+    # python-whois returns a value, a list of values (one per registry
+    # server that answered) or None
+    if isinstance(value, (list, tuple)):
+        value = value[0] if value else None
+    if value is None:
+        return None
+    return str(value).strip()
+
+
+def name_servers(value):
+    if value is None:
+        return []
+    if isinstance(value, str):
+        value = value.split()
+    servers = set()
+    for ns in value:
+        ns = str(ns).strip().rstrip(".").lower()
+        # some registries list glue IPs next to the names
+        if ns and not re.search(r"\d$", ns):
+            servers.add(ns)
+    return sorted(servers)
+
+
+def fresh(record, ttl=None):
+    if ttl is None:
+        ttl = getattr(settings, "DNSQUERY_WHOIS_TTL", 24 * 3600)
+    age = record.age()
+    return age is not None and age < timedelta(seconds=ttl)
+
+
+def cached(domain):
+    row = store.load_whois(store.connect(), domain)
+    if row is None:
+        return None
+    registrar, expiration_date, servers, fetched_at = row
+    return WhoisRecord(domain, registrar, expiration_date, servers.split(), fetched_at)
+
+
+def fetch(domain, limiter=None):
+    # python-whois compiles its parsers on import; first WHOIS pays for it
+    import whois
+    if limiter is not None:
+        limiter.acquire()
+    try:
+        with metrics.span("whois_query"):
+            w = whois.whois(domain)
+        record = WhoisRecord.parse(domain, w)
+    except Exception as e:
+        # not cached, the next report tries again
+        logger.warning("whois %s failed: %r", domain, e)
+        return WhoisRecord(domain)
+    store.save_whois(store.connect(), record)
+    return record
+
+
+def lookup(domain, stats=None, ttl=None, limiter=None):
+    domain = store.domain_key(domain)
+    record = cached(domain)
+    if record is not None and fresh(record, ttl):
+        if stats is not None:
+            stats.add("whois_cache_hits")
+        return record
+    with _locks[hash(domain) % len(_locks)]:
+        # another thread may have fetched it while we waited
+        record = cached(domain)
+        if record is not None and fresh(record, ttl):
+            if stats is not None:
+                stats.add("whois_cache_hits")
+            return record
+        if stats is not None:
+            stats.add("whois_queries")
+        return fetch(domain, limiter)
@@ -0,0 +1,224 @@
+"""Whole-zone snapshots, by zone transfer, of the zones we serve ourselves.
+
+Each zone in DNSQUERY_XFR_ZONES (origin -> primary address, or (address,
+port)) is pulled once with AXFR into a dns.zone.Zone.  Lookups of a
+report on names in the zone are answered from it; a name the zone
+cannot answer authoritatively (below a delegation, behind a CNAME, or
+possibly covered by a wildcard) is still resolved as usual.
+
+Every DNSQUERY_XFR_REFRESH seconds the primary is asked for an IXFR
+from the snapshot's serial, in the background; the deltas are applied
+to a copy of the zone, or the zone is pulled again with AXFR when the
+primary does not send deltas.  The old snapshot is served meanwhile,
+and kept if the transfer fails.
+"""
+import logging
+import threading
+import time
+
+import dns.exception
+import dns.name
+import dns.query
+import dns.rdataclass
+import dns.rdataset
+import dns.rdatatype
+import dns.resolver
+import dns.rrset
+import dns.zone
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+TRANSFER_TIMEOUT = 10
+MISS = (False, None)
+
+_zones = None
+_zones_lock = threading.Lock()
+
+
+def copy_zone(zone):
+    copy = dns.zone.Zone(zone.origin, zone.rdclass, relativize=False)
+    for name, node in zone.items():
+        for rdataset in node:
+            copy.find_rdataset(name, rdataset.rdtype, rdataset.covers,
+                               create=True).update(rdataset)
+    return copy
+
+
+def zone_from_rrsets(origin, rrsets):
+    zone = dns.zone.Zone(origin, relativize=False)
+    for rrset in rrsets:
+        zone.find_rdataset(rrset.name, rrset.rdtype, create=True).update(rrset)
+    return zone
+
+
+def apply_ixfr(zone, rrsets):
+    # rrsets of an IXFR answer, one RR each: the new SOA, then for every
+    # version the old SOA, the RRs deleted, the next SOA and the RRs
+    # added, and the new SOA again
+    zone = copy_zone(zone)
+    adding = True
+    for rrset in rrsets[1:-1]:
+        if rrset.rdtype == dns.rdatatype.SOA and rrset.name == zone.origin:
+            adding = not adding
+            continue
+        if adding:
+            zone.find_rdataset(rrset.name, rrset.rdtype, create=True).add(rrset[0], rrset.ttl)
+            continue
+        rdataset = zone.get_rdataset(rrset.name, rrset.rdtype)
+        if rdataset is not None:
+            rdataset.discard(rrset[0])
+            if not rdataset:
+                zone.delete_rdataset(rrset.name, rrset.rdtype)
+    soa = rrsets[0]
+    zone.replace_rdataset(zone.origin, dns.rdataset.from_rdata(soa.ttl, soa[0]))
+    return zone
+
+
+class ZoneSnapshot:
+    def __init__(self, origin, address, port=53):
+        self.origin = dns.name.from_text(origin)
+        self.address = address
+        self.port = port
+        self.zone = None
+        self.serial = None
+        self.wildcards = False
+        self.checked = 0.0
+        self._lock = threading.Lock()
+
+    def install(self, zone):
+        self.serial = zone.get_rdataset(zone.origin, dns.rdatatype.SOA)[0].serial
+        self.wildcards = any(name.labels[0] == b"*" for name in zone.keys())
+        self.zone = zone
+
+    def axfr(self):
+        with metrics.span("zone_transfer"):
+            zone = dns.zone.from_xfr(
+                dns.query.xfr(self.address, self.origin, port=self.port,
+                              lifetime=TRANSFER_TIMEOUT, relativize=False),
+                relativize=False)
+        self.install(zone)
+        return "axfr"
+
+    def ixfr(self):
+        try:
+            with metrics.span("zone_transfer"):
+                rrsets = [rrset for message in dns.query.xfr(
+                              self.address, self.origin, rdtype=dns.rdatatype.IXFR,
+                              serial=self.serial, port=self.port,
+                              lifetime=TRANSFER_TIMEOUT, relativize=False)
+                          for rrset in message.answer]
+        except dns.exception.FormError:
+            # deltas from another serial than ours
+            return self.axfr()
+        if len(rrsets) == 1:
+            return "current"
+        if rrsets[1].rdtype != dns.rdatatype.SOA:
+            # the primary answered with the whole zone
+            self.install(zone_from_rrsets(self.origin, rrsets[:-1]))
+            return "axfr"
+        self.install(apply_ixfr(self.zone, rrsets))
+        return "ixfr"
+
+    def transfer(self, interval=0):
+        # brings the snapshot up to date with the primary, unless another
+        # thread did within interval seconds while this one waited for the
+        # lock; returns how ("axfr", "ixfr", "current", None on failure)
+        with self._lock:
+            if self.checked and time.monotonic() - self.checked < interval:
+                return "current"
+            old = self.serial
+            try:
+                how = self.ixfr() if self.zone is not None else self.axfr()
+            except Exception as e:
+                logger.warning("zone transfer of %s from %s failed: %r",
+                               self.origin, self.address, e)
+                how = None
+            self.checked = time.monotonic()
+        if how not in (None, "current"):
+            logger.info("zone %s: %s, serial %s -> %s", self.origin, how, old, self.serial)
+        return how
+
+    def refresh(self, interval, wait):
+        # a due transfer runs in the background unless the caller has to
+        # wait for the first snapshot
+        if self.checked and time.monotonic() - self.checked < interval:
+            return
+        if self.zone is None and wait:
+            self.transfer(interval)
+        elif not self._lock.locked():
+            threading.Thread(target=self.transfer, args=(interval,), name="xfr",
+                             daemon=True).start()
+
+    def answer(self, qname, rdtype):
+        # (True, RRset or NXDOMAIN / NoAnswer) when the snapshot answers
+        # qname authoritatively, else MISS
+        zone = self.zone
+        if zone is None:
+            return MISS
+        name = qname
+        while name != zone.origin:
+            node = zone.get_node(name)
+            if node is not None and node.get_rdataset(zone.rdclass, dns.rdatatype.NS):
+                return MISS
+            name = name.parent()
+        node = zone.get_node(qname)
+        if node is None:
+            if self.wildcards:
+                return MISS
+            if any(name.is_subdomain(qname) for name in zone.keys()):
+                # an empty non-terminal
+                return True, dns.resolver.NoAnswer()
+            return True, dns.resolver.NXDOMAIN(qnames=[qname])
+        rdataset = node.get_rdataset(zone.rdclass, rdtype)
+        if rdataset is None:
+            if rdtype != dns.rdatatype.CNAME and node.get_rdataset(zone.rdclass,
+                                                                   dns.rdatatype.CNAME):
+                return MISS
+            return True, dns.resolver.NoAnswer()
+        rrset = dns.rrset.RRset(qname, zone.rdclass, rdtype)
+        rrset.update(rdataset)
+        return True, rrset
+
+
+class ZoneSnapshots:
+    def __init__(self, zones, interval=60):
+        self.interval = interval
+        self.snapshots = {}
+        for origin, server in zones.items():
+            address, port = server if isinstance(server, (tuple, list)) else (server, 53)
+            snapshot = ZoneSnapshot(origin, address, port)
+            self.snapshots[snapshot.origin] = snapshot
+
+    def find(self, qname):
+        name = qname
+        while True:
+            if name in self.snapshots:
+                return self.snapshots[name]
+            if name == dns.name.root:
+                return None
+            name = name.parent()
+
+    def lookup(self, key, wait=True):
+        # (True, answer) for a (qname, rdtype) key of resolve.QueryPlan
+        # that a zone snapshot answers, else MISS
+        qname = dns.name.from_text(key[0])
+        snapshot = self.find(qname)
+        if snapshot is None:
+            return MISS
+        snapshot.refresh(self.interval, wait)
+        return snapshot.answer(qname, dns.rdatatype.from_text(key[1]))
+
+
+def get_zones():
+    # None while DNSQUERY_XFR_ZONES is empty
+    global _zones
+    zones = getattr(settings, "DNSQUERY_XFR_ZONES", {})
+    if not zones:
+        return None
+    with _zones_lock:
+        if _zones is None:
+            _zones = ZoneSnapshots(zones, getattr(settings, "DNSQUERY_XFR_REFRESH", 60))
+        return _zones